@@ -4,156 +4,169 @@ Runtimes:
     - size: 750, time: 15.547s
     - size: 9000, time: 53.225s
     - size: 445715, time: 1937.396s (32 min)
+
+Usage:
+    python assign_paper_kwds.py
+    python assign_paper_kwds.py --workers 8
+    python assign_paper_kwds.py --shard 0/4 --workers 8
+    python assign_paper_kwds.py --shard 0/4 --workers 8 --resume
+
+Papers are split into shards by MOD(id, N) so each shard gets an even share
+of the (sparse) MAG id range. --shard i/N restricts this run to shard i of N,
+which lets several machines split one run. --workers W further splits the
+shard across W processes on this machine; each worker loads the keyword
+matcher and embeddings once and writes its own Publication_FoS rows.
+
+Papers are streamed from the db in id order, so --resume can pick up each
+(sub-)shard after the last paper that has Publication_FoS rows. Resume with
+the same --shard and --workers values as the interrupted run.
 """
-import re
-import sys
-import pickle
-import math
+import os
+import argparse
 import numpy as np
-import pandas as pd
 import mysql.connector
-import numpy.linalg as la
-from sklearn.cluster import DBSCAN
-
-from trie import construct_trie, construct_re, get_matches
-from utils import read_pickle_file, write_pickle_data, get_top_k, concat_paper_info, standardize_non_ascii
-
-
+from multiprocessing import Pool
 
-def normalize_embs(emb_arr):
-    emb_norms = la.norm(emb_arr, axis=1)
-    return emb_arr / emb_norms[:,None]
-
-def normalize_vec(vec):
-    return vec / la.norm(vec)
+from trie import match_texts, load_matcher
+from embedding_store import EmbeddingStore
+from build_keyword_matcher import build_keyword_matcher, get_matcher_file, get_keyword_id
+from keyword_graph import load_keyword_graph, get_dedup_labels
+from keyword_scoring import build_penalty_divisors, score_block, get_row_scores
+from change_log import bump_data_version
+from utils import read_pickle_file, get_top_k_rows, concat_paper_info, stream_papers, get_chunks, BulkInserter
 
 
 data_root_dir = 'setup_data/'
 
 ids_file = data_root_dir + "springer_word_to_id.pickle"
-golden_keywords_file = data_root_dir + "golden_words.csv"
 
 word_to_other_freq_file = data_root_dir + "other_freqs.pickle"
 
-paper_embeddings_file = data_root_dir + "SB_paper_embeddings.pickle"
-paper_ids_file = data_root_dir + "SB_paper_embedding_mag_ids.pickle"
+# Embedding stores converted from SB_paper_embeddings.pickle +
+# SB_paper_embedding_mag_ids.pickle and springer_keyword_embs.pickle
+# (normalized) by embedding_store.py
+paper_store_dir = data_root_dir + "SB_paper_embeddings"
+keyword_store_dir = data_root_dir + "springer_keyword_embs"
 
-keyword_embeddings_file = data_root_dir + "springer_keyword_embs.pickle"
+# Built from springer_keyword_embs.pickle by keyword_graph.py
+keyword_graph_file = data_root_dir + "springer_keyword_graph.npz"
 
+db_config = {
+    'host': "localhost",
+    'user': "aukey2",
+    'password': "aUkeyWwords",
+    'database': "aukey2_experts_v2"
+}
 
+max_keywords = 9
+query_keywords = 17
+paper_batch_size = 1000
+score_block_size = 1000
 
 
-### Reading data from files ###
-print("Loading and preprocessing data")
+# Per-process state, filled in once by load_data()
+paper_store = None
+word_to_id = None
+word_to_other_freq = None
+keyword_embeddings = None
+penalty_divisors = None
+keyword_graph = None
+keywords_re = None
 
-paper_ids = read_pickle_file(paper_ids_file)
-paper_embeddings = read_pickle_file(paper_embeddings_file)
-word_to_id = read_pickle_file(ids_file)
 
-# Frequency counts of keywords for non-cs papers from arxiv
-word_to_other_freq = read_pickle_file(word_to_other_freq_file)
+def load_data(matcher_engine='aho-corasick'):
+    """
+    Reads the embeddings, keyword mappings and keyword matcher into
+    this process' globals. Called once per process (worker initializer).
 
-keyword_embeddings = read_pickle_file(keyword_embeddings_file)
-keyword_embeddings = normalize_embs(keyword_embeddings)
+    matcher_engine is 'regex' or 'aho-corasick' (see trie.construct_matcher);
+    both find the same keywords. The matcher is loaded from the file saved
+    by build_keyword_matcher.py, or built here if that file is missing.
+    """
+    global paper_store, word_to_id, word_to_other_freq
+    global keyword_embeddings, penalty_divisors, keyword_graph, keywords_re
 
+    print("Loading and preprocessing data")
 
+    paper_store = EmbeddingStore(paper_store_dir)
+    word_to_id = read_pickle_file(ids_file)
 
-"""
-Keyword set formed from the set intersection of
-- Springer set: parse papers for author-labeled keywords and keep those
-with freq >= 5
-- EmbedRank set: Use EmbedRank to extract keywords from entire cs corpus.
-"""
-golden_keywords = pd.read_csv(golden_keywords_file)
-golden_keywords = set(golden_keywords['word'])
+    # Frequency counts of keywords for non-cs papers from arxiv
+    word_to_other_freq = read_pickle_file(word_to_other_freq_file)
 
+    # Stored normalized, row = keyword id
+    keyword_embeddings = EmbeddingStore(keyword_store_dir).embeddings
 
-mydb = mysql.connector.connect(
-  host="localhost",
-  user="aukey2",
-  password="aUkeyWwords",
-  database="aukey2_experts_v2"
-)
-mycursor = mydb.cursor()
+    # Penalize general words (frequent in non-cs papers)
+    penalty_divisors = build_penalty_divisors(word_to_id, word_to_other_freq, len(keyword_embeddings))
 
+    # Neighbourhoods of near-duplicate keywords
+    keyword_graph, _ = load_keyword_graph(keyword_graph_file)
 
+    matcher_file = get_matcher_file(matcher_engine)
+    keywords_re = None
+    if os.path.exists(matcher_file):
+        try:
+            keywords_re, _ = load_matcher(matcher_file)
+        except ValueError as e:
+            print(str(e) + ", rebuilding it (rerun build_keyword_matcher.py to update the file)")
+    else:
+        print("No saved keyword matcher at " + matcher_file + ", building it (see build_keyword_matcher.py)")
 
-paper_id_to_idx = {}
-for i in range(len(paper_ids)):
-    paper_id_to_idx[paper_ids[i]] = i
+    if keywords_re is None:
+        keywords_re = build_keyword_matcher(matcher_engine)
 
 
-mycursor.execute("""
-    SELECT id, title, abstract
-    FROM Publication
-    WHERE abstract IS NOT NULL
-""")
-papers = mycursor.fetchall()
+def get_match_id(keyword):
+    return get_keyword_id(word_to_id, keyword)
 
 
+def connect_db():
+    return mysql.connector.connect(**db_config)
 
-keywords_trie = construct_trie(golden_keywords)
-keywords_re = construct_re(keywords_trie)
-print("Starting paper keyword extraction: ")
-
-
-p_i = 0
-for paper in papers:
-
-    paper_id = paper[0]
-    raw_text = concat_paper_info(paper[1], paper[2])
-
-    # Get candidate keywords by checking occurrence
-    keyword_matches = get_matches(raw_text, keywords_re, True)
-
-    print(paper[1], keyword_matches)
-    if len(keyword_matches) == 0:
-        continue
 
+def parse_shard(shard_str):
+    """
+    Parses a shard spec of the form 'i/N' into (i, N) with 0 <= i < N.
+    """
     try:
-        match_ids = list(map(lambda t: word_to_id[t[0]], keyword_matches))
-    except:
-        match_ids = list(map(lambda t: word_to_id[standardize_non_ascii(t[0])], keyword_matches))
-
+        shard_idx, num_shards = map(int, shard_str.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be of the form i/N, got " + repr(shard_str))
 
-    match_embs = keyword_embeddings[match_ids]
+    if num_shards < 1:
+        raise argparse.ArgumentTypeError("number of shards N must be at least 1, got " + repr(shard_str))
+    if not 0 <= shard_idx < num_shards:
+        raise argparse.ArgumentTypeError("shard index must satisfy 0 <= i < N, got " + repr(shard_str))
 
-    paper_embedding = paper_embeddings[paper_id_to_idx[paper_id]]
-    paper_embedding = normalize_vec(paper_embedding)
+    return shard_idx, num_shards
 
-    sim_scores = np.dot(match_embs, paper_embedding.T)
 
-    keyword_scores = []
-    for i in range(len(match_ids)):
-        m_t = keyword_matches[i]
-        keyword = m_t[0]
+def get_query_k(num_candidates):
+    """
+    Number of top-scoring candidates of a paper that go through dedup.
+    Papers with at most query_keywords candidates drop their lowest-scoring
+    one (unless it is the only candidate).
+    """
+    return np.minimum(query_keywords, np.maximum(num_candidates - 1, 1))
 
-        kw_score = sim_scores[i]
 
-        # Checking if current keyword appears in non-cs papers in arxiv corpus
-        if keyword in word_to_other_freq:
-            other_freq = word_to_other_freq[keyword]
+def select_keywords(top_keywords):
+    """
+    Picks the final keywords of a paper from its top-scoring candidates.
 
-            # Penalize general words
-            if other_freq >= 1000:
-                kw_score /= math.sqrt(other_freq)
-
-        kw_t = (match_ids[i], kw_score)
-        keyword_scores.append(kw_t)
-
-
-    # Select top-k-scoring keywords
-    max_keywords = 9
-    query_keywords = 17
-    top_keywords = get_top_k(keyword_scores, min(query_keywords, len(keyword_scores) - 1), lambda t: t[1])
+    Arguments:
+    - top_keywords: list of (keyword_id, score) tuples, best first, as
+      selected by get_top_k_rows with get_query_k
 
+    Returns: list of (keyword_id, score) tuples, best first, with at most
+    one keyword per group of near-duplicate keywords.
+    """
     selected_keyword_ids = [t[0] for t in top_keywords]
-    selected_keyword_embs = keyword_embeddings[selected_keyword_ids]
 
 
-    # Removing dupicate keywords
-    db = DBSCAN(eps=0.47815, min_samples=2).fit(selected_keyword_embs)
-    labels = db.labels_
+    # Removing dupicate keywords (same groups as DBSCAN(eps=0.47815, min_samples=2))
+    labels = get_dedup_labels(selected_keyword_ids, keyword_graph)
 
     curr_groups = set()
     unique_top_keywords = []
@@ -170,25 +183,169 @@ for paper in papers:
             curr_groups.add(group_idx)
             unique_top_keywords.append(top_keywords[i])
 
-    top_keywords = unique_top_keywords
-    print("The top keywords: ", top_keywords)
-    print("-" * 10)
+    return unique_top_keywords
 
-    # Insert data into db
-    for kw_t in top_keywords:
-        keyword_id = str(kw_t[0])
-        keyword_score = str(kw_t[1])
 
-        insert_sql = "INSERT INTO Publication_FoS (publication_id, FoS_id, score) VALUES (%s, %s, %s)"
-        mycursor.execute(insert_sql, [paper_id, keyword_id, keyword_score])
+def extract_block_keywords(papers):
+    """
+    Selects keywords for a block of papers.
 
-    mydb.commit()
+    Arguments:
+    - papers: list of (id, title, abstract) tuples from the Publication table
+
+    Returns: list with one entry per paper, each a list of (keyword_id, score)
+    tuples, best first. Empty if no golden keyword occurs in the paper.
+
+    Golden keywords are matched in the title and abstract of every paper
+    (trie.match_texts), and all candidates of the block are scored together
+    by keyword_scoring.
+    """
+    # The Aho-Corasick matcher reports FoS ids directly; regex matches are
+    # looked up with get_match_id
+    paper_texts = [concat_paper_info(paper[1], paper[2]) for paper in papers]
+    match_matrix = match_texts(paper_texts, keywords_re, len(keyword_embeddings), get_match_id)
+
+    block_paper_embs = paper_store.get([paper[0] for paper in papers])
+
+    scored_matrix = score_block(match_matrix, block_paper_embs, keyword_embeddings, penalty_divisors)
+
+    # Select top-k-scoring keywords of every paper at once
+    top_matrix = get_top_k_rows(scored_matrix, get_query_k(np.diff(scored_matrix.indptr)))
+
+    return [select_keywords(top_keywords) if len(top_keywords) > 0 else []
+            for top_keywords in get_row_scores(top_matrix)]
+
+
+def get_resume_id(cur, shard):
+    """
+    Returns the id of the last paper in a shard that already has keywords
+    stored, or None if the shard has not been started.
+
+    Papers are processed and committed in id order, so every paper of the
+    shard up to this id has been analyzed.
+    """
+    shard_idx, num_shards = shard
+    cur.execute("""
+        SELECT MAX(publication_id)
+        FROM Publication_FoS
+        WHERE MOD(publication_id, %s) = %s
+    """, (num_shards, shard_idx))
 
+    return cur.fetchone()[0]
 
-    if p_i % 10000 == 0:
-        print("On " + str(p_i) + "th paper")
-    p_i += 1
 
+def process_shard(shard, resume=False, insert_batch_size=1000, commit_size=10000):
+    """
+    Extracts and stores keywords for every paper in one shard.
+
+    Arguments:
+    - shard: (shard_idx, num_shards); the shard holds papers with
+      id % num_shards == shard_idx
+    - resume: skip papers up to the last one with stored keywords
+    - insert_batch_size: number of Publication_FoS rows sent per INSERT
+    - commit_size: minimum number of rows between commits; commits only
+      happen between papers, so resume never sees a half-written paper
+
+    Returns: number of papers analyzed.
+
+    Opens its own db connection, so it can run in a worker process.
+    """
+    shard_idx, num_shards = shard
+
+    mydb = connect_db()
+    mycursor = mydb.cursor()
+
+    start_after_id = None
+    if resume:
+        start_after_id = get_resume_id(mycursor, shard)
+
+    papers = stream_papers(mydb, paper_batch_size, start_after_id, shard)
+    publication_fos_writer = BulkInserter(mydb, "Publication_FoS", ["publication_id", "FoS_id", "score"],
+                                          insert_batch_size, commit_size)
+
+    print("Starting paper keyword extraction for shard " + str(shard_idx) + "/" + str(num_shards)
+          + (" after id " + str(start_after_id) if start_after_id is not None else ""))
+
+    p_i = 0
+    for paper_block in get_chunks(papers, score_block_size):
+        block_keywords = extract_block_keywords(paper_block)
+
+        for paper, top_keywords in zip(paper_block, block_keywords):
+            paper_id = paper[0]
+
+            if len(top_keywords) == 0:
+                continue
+
+            print("The top keywords: ", top_keywords)
+            print("-" * 10)
+
+            # Insert data into db
+            for kw_t in top_keywords:
+                keyword_id = str(kw_t[0])
+                keyword_score = str(kw_t[1])
+
+                publication_fos_writer.add([paper_id, keyword_id, keyword_score])
+
+            publication_fos_writer.commit_if_due()
+
+
+            if p_i % 10000 == 0:
+                print("Shard " + str(shard_idx) + ": on " + str(p_i) + "th paper")
+            p_i += 1
+
+    publication_fos_writer.close()
+    mycursor.close()
+    mydb.close()
+    return p_i
+
+
+def get_worker_shards(shard_idx, num_shards, num_workers):
+    """
+    Splits shard i/N into num_workers sub-shards of the form (j, N * W).
+
+    Sub-shard j = i + N*w satisfies j % N == i, so the sub-shards of every
+    machine are disjoint and together cover exactly shard i/N.
+    """
+    total_shards = num_shards * num_workers
+    return [(shard_idx + num_shards * w, total_shards) for w in range(num_workers)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Assign keywords to papers")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                        help="process only shard i of N, given as i/N (default 0/1)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes on this machine")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue each shard after its last paper with stored keywords")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="Publication_FoS rows per INSERT statement")
+    parser.add_argument('--commit-size', type=int, default=10000,
+                        help="minimum Publication_FoS rows per commit")
+    parser.add_argument('--matcher', choices=['regex', 'aho-corasick'], default='aho-corasick',
+                        help="keyword matching engine")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    shard_idx, num_shards = args.shard
+    worker_shards = get_worker_shards(shard_idx, num_shards, args.workers)
+
+    if args.workers == 1:
+        load_data(args.matcher)
+        shard_counts = [process_shard(worker_shards[0], args.resume, args.batch_size, args.commit_size)]
+    else:
+        with Pool(args.workers, initializer=load_data, initargs=(args.matcher,)) as pool:
+            shard_args = [(shard, args.resume, args.batch_size, args.commit_size) for shard in worker_shards]
+            shard_counts = pool.starmap(process_shard, shard_args, chunksize=1)
+
+    # Invalidates cached expert rankings
+    mydb = connect_db()
+    mycursor = mydb.cursor()
+    bump_data_version(mycursor, "Publication_FoS")
+    mydb.commit()
+    mycursor.close()
+    mydb.close()
 
-# mydb.commit()
-print("Done. Total papers analyzed: " + str(p_i))
+    print("Done. Total papers analyzed: " + str(sum(shard_counts)))
@@ -1,57 +1,193 @@
 """
-In main loop, takes 103 s / 300 author.
-Estimate time for 16,324 authors: < 2 hrs
+Assigns keywords to authors (Author_FoS) from the keywords of their
+publications (Publication_FoS).
+
+Runtimes:
+    - per-author mode: 103 s / 300 authors, estimate for 16,324 authors: < 2 hrs
+
+Usage:
+    python assign_researcher_kwds.py
+    python assign_researcher_kwds.py --mode per-author --workers 8
+    python assign_researcher_kwds.py --retry-failed
+    python assign_researcher_kwds.py --incremental
+
+The default bulk mode reads Publication_FoS, Publication_Author and the
+citation counts once and scores blocks of authors with the sparse group-by
+operations in author_scoring.py. The per-author mode runs the original SQL
+aggregation once per author. Both pass each author's candidates through
+select_author_keywords.
+
+With --workers W the per-author mode splits the authors into chunks that W
+processes work through, each with its own pooled db connection.
+
+Authors that fail are written with their error to author_fos_failures.tsv
+(replaced on every run); --retry-failed reruns only those authors.
+
+--incremental only recomputes the authors of publications whose keywords,
+authors or citation count changed since the last run, as recorded by the
+triggers of change_log.py (run python change_log.py once, then a full run).
+Each block of those authors has its old Author_FoS rows replaced in one
+transaction.
 """
+import os
 import math
+import argparse
 import mysql.connector
-from sklearn.cluster import DBSCAN
+import mysql.connector.pooling
+from multiprocessing import Pool
 
 import numpy as np
-import numpy.linalg as la
 
-from utils import read_pickle_file, write_pickle_data, get_top_k, concat_paper_info, standardize_non_ascii
+from keyword_graph import load_keyword_graph, get_dedup_labels
+from author_scoring import build_pub_keyword_matrix, build_author_pub_matrix, score_authors
+from change_log import get_log_position, get_watermark, set_watermark, get_changed_authors, prune_change_log, bump_data_version
+from utils import get_top_k, get_top_k_rows, fetch_columns, gen_sql_in_tup, BulkInserter
 
-def normalize_embs(emb_arr):
-    emb_norms = la.norm(emb_arr, axis=1)
-    return emb_arr / emb_norms[:,None]
 
-def normalize_vec(vec):
-    return vec / la.norm(vec)
-
-
-print("Loading and preprocessing data.")
 data_root_dir = 'setup_data/'
 keyword_embeddings_file = data_root_dir + "springer_keyword_embs.pickle"
 
-keyword_embeddings = read_pickle_file(keyword_embeddings_file)
-keyword_embeddings = normalize_embs(keyword_embeddings)
+# Built from keyword_embeddings_file by keyword_graph.py
+keyword_graph_file = data_root_dir + "springer_keyword_graph.npz"
+
+# Authors whose keywords could not be assigned in the last run
+failures_file = data_root_dir + "author_fos_failures.tsv"
+
+# Name of this job in the change log's watermark table
+refresh_name = "Author_FoS"
 
+db_config = {
+    'host': "localhost",
+    'user': "aukey2",
+    'password': "aUkeyWwords",
+    'database': "aukey2_experts_v2"
+}
 
-mydb = mysql.connector.connect(
-  host="localhost",
-  user="aukey2",
-  password="aUkeyWwords",
-  database="aukey2_experts_v2"
-)
-mycursor = mydb.cursor()
+# Author_FoS rows per INSERT statement and minimum rows between commits
+insert_batch_size = 1000
+commit_size = 5000
+
+# Number of authors scored together in bulk mode
+author_block_size = 2000
+
+# Number of authors handed to a worker at a time in per-author mode
+author_chunk_size = 500
 
 exp_multiplier = 7
 exp_base = math.exp(exp_multiplier)
-print("Hyper param multiplier: " + str(exp_multiplier))
 
-def finger_print_author(query_author_id):
+# Candidates per author, keywords (or keyword groups) kept after dedup,
+# and keywords stored per author
+query_keywords = 70
+max_candidates = 40
+max_keywords = 17
+
+
+keyword_graph = None
+
+# Connection pool of a per-author worker process, see init_worker
+worker_db_pool = None
+
+
+def load_data():
+    global keyword_graph
+
+    print("Loading and preprocessing data.")
+    print("Hyper param multiplier: " + str(exp_multiplier))
+
+    keyword_graph, _ = load_keyword_graph(keyword_graph_file)
+
+
+def connect_db():
+    return mysql.connector.connect(**db_config)
+
+
+def init_worker():
+    """
+    Per-author worker initializer: loads the data (unless inherited from
+    the parent) and opens this worker's connection pool.
+    """
+    global worker_db_pool
+
+    if keyword_graph is None:
+        load_data()
+
+    worker_db_pool = mysql.connector.pooling.MySQLConnectionPool(
+        pool_name="author_fos_" + str(os.getpid()), pool_size=1, **db_config)
+
+
+def write_failures(failures, out_file=failures_file):
+    """
+    Writes (author_id, error message) pairs, one tab-separated line each.
+    """
+    with open(out_file, 'w', encoding='utf-8') as f:
+        for author_id, err in failures:
+            f.write(str(author_id) + "\t" + " ".join(err.split()) + "\n")
+
+
+def read_failed_author_ids(failures_file=failures_file):
+    with open(failures_file, encoding='utf-8') as f:
+        return [int(line.split("\t")[0]) for line in f if line.strip()]
+
+
+def select_author_keywords(keyword_scores):
     """
-    Assigns a set of keywords to an author.
+    Picks an author's keywords from their scored candidates.
 
     Arguments:
+    - keyword_scores: list of (keyword_id, score) tuples, best first
+
+    Returns: list of at most max_keywords (keyword_id, score) tuples, best
+    first. Near-duplicate keywords are merged into one group whose score
+    is the sum of its members' scores, under the id of its best member.
+    """
+    if len(keyword_scores) == 0:
+        return []
+
+    selected_keyword_ids = [t[0] for t in keyword_scores]
+
+    # Remove duplicates, same groups as DBSCAN(eps=0.47815, min_samples=2)
+    labels = get_dedup_labels(selected_keyword_ids, keyword_graph)
+
+    group_to_score = {}
+    ungrouped_words = []
+    for i in range(len(keyword_scores)):
+
+        num_total_selected = len(group_to_score) + len(ungrouped_words)
+        if num_total_selected >= max_candidates:
+            break
+
+        kw_t = keyword_scores[i]
+        group_idx = labels[i]
+
+        if group_idx == -1:
+            ungrouped_words.append(kw_t)
+        else:
+            if group_idx not in group_to_score:
+                group_to_score[group_idx] = [kw_t[0], kw_t[1]]
+            else:
+                group_to_score[group_idx][1] += kw_t[1]
+
+    grouped_keyword_scores = [tuple(t) for t in group_to_score.values()] + ungrouped_words
+
+    return get_top_k(grouped_keyword_scores, max_keywords, lambda t: t[1])
+
+
+def get_author_keyword_scores(cur, query_author_id):
+    """
+    Scores the keywords of one author with a single SQL aggregation.
+
+    Arguments:
+    - cur: mysql cursor
     - query_author_id: id of author for whom keywords are being assigned
 
-    Returns: None. Inserts author-keyword assignments into database.
+    Returns: list of at most query_keywords (keyword_id, score) tuples,
+    best first.
 
     The process transforms publication-keyword assigned scores using
     softmax-like-function f:
         score_i = a^(score_i) / sum_all_i { a^(score_i) }
-        where a = 7
+        where a = e^7
 
     and sums over each of these scores for each keyword across all
     the publications of an author.
@@ -92,80 +228,331 @@ def finger_print_author(query_author_id):
         ON word_scores.publication_id = publ_scores.publication_id
 
         GROUP BY word_scores.id
-        ORDER BY word_score DESC LIMIT 70
+        ORDER BY word_score DESC LIMIT %s
     """
 
-    query_tuple = 2 * (str(exp_base), str(query_author_id))
+    query_tuple = 2 * (str(exp_base), str(query_author_id)) + (query_keywords,)
 
-    mycursor.execute(author_keywords_sql, query_tuple)
-    selected_keyword_ts = mycursor.fetchall()
-    num_candidates = len(selected_keyword_ts)
+    cur.execute(author_keywords_sql, query_tuple)
+    return [(t[0], t[2]) for t in cur.fetchall()]
 
-    # print(selected_keyword_ts)
 
-    if num_candidates == 0:
-        return
+def finger_print_author(cur, query_author_id):
+    """
+    Assigns a set of keywords to an author with the per-author SQL.
 
-    selected_keyword_ids = [t[0] for t in selected_keyword_ts]
-    selected_keyword_embs = keyword_embeddings[selected_keyword_ids]
+    Returns: list of (keyword_id, score) tuples to store in Author_FoS.
+    """
+    return select_author_keywords(get_author_keyword_scores(cur, query_author_id))
 
-    # Remove duplicates using clustering algorithm
-    db = DBSCAN(eps=0.47815, min_samples=2).fit(selected_keyword_embs)
-    labels = db.labels_
 
+def add_failures(failures, author_ids, e):
+    for author_id in author_ids:
+        print("Error for " + str(author_id) + ": " + repr(e))
+        failures.append((author_id, repr(e)))
 
-    max_candidates = 40
-    group_to_score = {}
-    ungrouped_words = []
-    for i in range(num_candidates):
 
-        num_total_selected = len(group_to_score) + len(ungrouped_words)
-        if num_total_selected >= max_candidates:
-            break
+def write_author_keywords(author_fos_writer, author_id, keyword_ts, uncommitted_ids, failures):
+    """
+    Queues an author's Author_FoS rows and commits them if due.
 
-        kw_t = selected_keyword_ts[i]
-        group_idx = labels[i]
+    Arguments:
+    - uncommitted_ids: authors written since the last commit; author_id is
+      added to it, and it is emptied on every commit
+    - failures: list of (author_id, error message) to record failures in
 
-        if group_idx == -1:
-            ungrouped_words.append(kw_t)
+    If a write fails, author_fos_writer rolls back everything since the
+    last commit, so every author in uncommitted_ids is recorded as failed.
+    """
+    uncommitted_ids.append(author_id)
+    try:
+        author_fos_writer.add_many([(str(author_id), str(kw_t[0]), str(kw_t[1])) for kw_t in keyword_ts])
+        if author_fos_writer.commit_if_due():
+            del uncommitted_ids[:]
+    except Exception as e:
+        add_failures(failures, uncommitted_ids, e)
+        del uncommitted_ids[:]
+
+
+def close_author_writer(author_fos_writer, uncommitted_ids, failures):
+    """
+    Commits and closes author_fos_writer, recording every author in
+    uncommitted_ids as failed if the last commit fails.
+    """
+    try:
+        author_fos_writer.close()
+    except Exception as e:
+        add_failures(failures, uncommitted_ids, e)
+
+    del uncommitted_ids[:]
+
+
+def finger_print_authors(db, author_ids):
+    """
+    Per-author mode: one SQL aggregation per author.
+
+    Returns: list of (author_id, error message) for the authors that failed.
+    """
+    cur = db.cursor()
+    author_fos_writer = BulkInserter(db, "Author_FoS", ["author_id", "FoS_id", "score"],
+                                     insert_batch_size, commit_size)
+    failures = []
+    uncommitted_ids = []
+
+    for au_i, author_id in enumerate(author_ids):
+        try:
+            keyword_ts = finger_print_author(cur, author_id)
+        except Exception as e:
+            add_failures(failures, [author_id], e)
         else:
-            if group_idx not in group_to_score:
-                group_to_score[group_idx] = [kw_t[0], kw_t[1], kw_t[2]]
-            else:
-                group_to_score[group_idx][2] += kw_t[2]
+            write_author_keywords(author_fos_writer, author_id, keyword_ts, uncommitted_ids, failures)
 
-    grouped_keyword_scores = list(group_to_score.values()) + ungrouped_words
+        if au_i % 300 == 0:
+            print("On " + str(au_i) + "th author")
 
-    # print(grouped_keyword_scores)
-    max_keywords = 17
-    top_keyword_ts = get_top_k(grouped_keyword_scores, min(max_keywords, len(grouped_keyword_scores)), lambda t: t[2])
+    close_author_writer(author_fos_writer, uncommitted_ids, failures)
+    cur.close()
+    return failures
 
 
-    # Insert assignments into db
-    for kw_t in top_keyword_ts:
-      insert_sql = "INSERT INTO Author_FoS (author_id, FoS_id, score) VALUES (%s, %s, %s)"
-      insert_values = (str(query_author_id), str(kw_t[0]), str(kw_t[2]))
-      mycursor.execute(insert_sql, insert_values)
+def finger_print_author_chunk(author_ids):
+    """
+    Runs finger_print_authors in a worker on a connection from its pool.
+    """
+    db = worker_db_pool.get_connection()
+    try:
+        return finger_print_authors(db, author_ids)
+    finally:
+        # Returns the connection to the pool
+        db.close()
 
 
-print("Generating author fingerprint(s)")
+def finger_print_authors_parallel(author_ids, num_workers):
+    """
+    Per-author mode over num_workers processes, author_chunk_size authors
+    per task.
 
-mycursor.execute("SELECT id FROM Author")
-authors = mycursor.fetchall()
+    Returns: list of (author_id, error message) for the authors that failed.
+    """
+    author_chunks = [author_ids[i:i + author_chunk_size] for i in range(0, len(author_ids), author_chunk_size)]
 
-au_i = 0
-for author_t in authors:
-    author_id = author_t[0]
+    failures = []
+    with Pool(num_workers, initializer=init_worker) as pool:
+        for chunk_i, chunk_failures in enumerate(pool.imap_unordered(finger_print_author_chunk, author_chunks)):
+            failures += chunk_failures
+            print("Finished " + str(chunk_i + 1) + " / " + str(len(author_chunks)) + " author chunks")
 
+    return failures
+
+
+def load_publication_data(cur, author_ids=None):
+    """
+    Reads everything bulk mode needs, one query per table.
+
+    If author_ids is given, only the rows needed to score those authors are
+    read (through a temporary table of the ids).
+
+    Returns: dict of numpy arrays:
+    - pfs_pub_ids, pfs_fos_ids, pfs_scores: Publication_FoS
+    - pa_author_ids, pa_pub_ids: Publication_Author
+    - pub_ids, pub_citations: sorted ids and citation counts of the
+      publications with keywords
+    - fos_ids: sorted FoS ids
+    """
+    data = {}
+
+    pfs_sql = "SELECT publication_id, FoS_id, score FROM Publication_FoS"
+    pa_sql = "SELECT author_id, publication_mag_id FROM Publication_Author"
+    fos_pubs_sql = "SELECT DISTINCT publication_id FROM Publication_FoS"
+
+    if author_ids is not None:
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS Refresh_Authors (author_id BIGINT PRIMARY KEY)")
+        cur.execute("DELETE FROM Refresh_Authors")
+        cur.executemany("INSERT IGNORE INTO Refresh_Authors (author_id) VALUES (%s)",
+                        [(author_id,) for author_id in author_ids])
+
+        author_pubs_sql = """(
+            SELECT DISTINCT publication_mag_id AS publication_id
+            FROM Publication_Author
+            JOIN Refresh_Authors USING (author_id)
+        ) AS author_pubs"""
+
+        pfs_sql = """
+            SELECT Publication_FoS.publication_id, FoS_id, score
+            FROM Publication_FoS
+            JOIN """ + author_pubs_sql + """ ON author_pubs.publication_id = Publication_FoS.publication_id
+        """
+        pa_sql += " JOIN Refresh_Authors USING (author_id)"
+        fos_pubs_sql = """
+            SELECT DISTINCT Publication_FoS.publication_id
+            FROM Publication_FoS
+            JOIN """ + author_pubs_sql + """ ON author_pubs.publication_id = Publication_FoS.publication_id
+        """
+
+    print("Loading Publication_FoS")
+    data['pfs_pub_ids'], data['pfs_fos_ids'], data['pfs_scores'] = fetch_columns(
+        cur, pfs_sql, [np.int64, np.int64, np.float64])
+
+    print("Loading Publication_Author")
+    data['pa_author_ids'], data['pa_pub_ids'] = fetch_columns(cur, pa_sql, [np.int64, np.int64])
+
+    print("Loading citation counts")
+    # A NULL citation count adds nothing to a keyword's sum, same as 0
+    data['pub_ids'], data['pub_citations'] = fetch_columns(cur, """
+        SELECT Publication.id, COALESCE(citation, 0)
+        FROM Publication
+        JOIN (""" + fos_pubs_sql + """) AS fos_pubs
+        ON fos_pubs.publication_id = Publication.id
+        ORDER BY Publication.id
+    """, [np.int64, np.float64])
+
+    data['fos_ids'], = fetch_columns(cur, "SELECT id FROM FoS ORDER BY id", [np.int64])
+
+    return data
+
+
+def finger_print_authors_bulk(db, author_ids, replace=False):
+    """
+    Bulk mode: scores author_block_size authors at a time from arrays held
+    in memory.
+
+    With replace=True only the data of author_ids is loaded, and each
+    block's existing Author_FoS rows are deleted and its new rows inserted
+    in a single transaction, so readers never see a half-refreshed author.
+
+    Returns: list of (author_id, error message) for the authors that failed.
+    """
+    cur = db.cursor()
+    data = load_publication_data(cur, author_ids if replace else None)
+
+    pub_keyword_matrix = build_pub_keyword_matrix(data['pfs_pub_ids'], data['pfs_fos_ids'], data['pfs_scores'],
+                                                  data['pub_ids'], data['pub_citations'], data['fos_ids'], exp_base)
+    fos_ids = data['fos_ids']
+
+    author_fos_writer = BulkInserter(db, "Author_FoS", ["author_id", "FoS_id", "score"],
+                                     insert_batch_size, commit_size)
+    failures = []
+    uncommitted_ids = []
+
+    for block_start in range(0, len(author_ids), author_block_size):
+        block_author_ids = np.asarray(author_ids[block_start:block_start + author_block_size], dtype=np.int64)
+
+        author_pub_matrix = build_author_pub_matrix(data['pa_author_ids'], data['pa_pub_ids'],
+                                                    block_author_ids, data['pub_ids'])
+        author_scores = get_top_k_rows(score_authors(author_pub_matrix, pub_keyword_matrix), query_keywords)
+
+        block_keywords = []
+        for i, author_id in enumerate(block_author_ids.tolist()):
+            start, end = author_scores.indptr[i], author_scores.indptr[i + 1]
+            keyword_scores = list(zip(fos_ids[author_scores.indices[start:end]].tolist(),
+                                      author_scores.data[start:end].tolist()))
+
+            try:
+                block_keywords.append((author_id, select_author_keywords(keyword_scores)))
+            except Exception as e:
+                add_failures(failures, [author_id], e)
+
+        if replace:
+            # The block's deletes and inserts commit (or roll back) together
+            try:
+                cur.execute("DELETE FROM Author_FoS WHERE author_id IN " + gen_sql_in_tup(len(block_author_ids)),
+                            block_author_ids.tolist())
+                for author_id, keyword_ts in block_keywords:
+                    author_fos_writer.add_many([(str(author_id), str(kw_t[0]), str(kw_t[1])) for kw_t in keyword_ts])
+                author_fos_writer.commit()
+            except Exception as e:
+                author_fos_writer.rollback()
+                add_failures(failures, [t[0] for t in block_keywords], e)
+        else:
+            for author_id, keyword_ts in block_keywords:
+                write_author_keywords(author_fos_writer, author_id, keyword_ts, uncommitted_ids, failures)
+
+        print("On " + str(block_start + len(block_author_ids)) + "th author")
+
+    close_author_writer(author_fos_writer, uncommitted_ids, failures)
+    cur.close()
+    return failures
+
+
+def get_start_position(db):
+    """
+    Returns: current change log position, or None if change_log.py has not
+    been set up on this db.
+    """
+    cur = db.cursor()
     try:
-        finger_print_author(author_id)
-        mydb.commit()
-    except:
-        print("Error for " + str(author_id))
+        return get_log_position(cur)
+    except mysql.connector.errors.ProgrammingError:
+        return None
+    finally:
+        cur.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Assign keywords to authors (Author_FoS)")
+    parser.add_argument('--mode', choices=['bulk', 'per-author'], default='bulk',
+                        help="bulk: score all authors from in-memory arrays; per-author: one SQL query per author")
+    parser.add_argument('--workers', type=int, default=1, help="processes for --mode per-author")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="only process the authors listed in " + failures_file)
+    parser.add_argument('--incremental', action='store_true',
+                        help="only refresh the authors of publications changed since the last run (bulk mode)")
+    args = parser.parse_args()
+
+    # Incremental runs replace each block of authors in one transaction,
+    # which only bulk mode does
+    if args.incremental and (args.mode != 'bulk' or args.workers != 1 or args.retry_failed):
+        parser.error("--incremental runs in bulk mode and cannot be combined with --mode per-author, "
+                     "--workers or --retry-failed")
+
+    load_data()
+
+    print("Generating author fingerprint(s)")
+
+    mydb = connect_db()
+    start_position = None
+
+    if args.incremental:
+        mycursor = mydb.cursor()
+        last_position = get_watermark(mycursor, refresh_name)
+        if last_position is None:
+            raise SystemExit("No " + refresh_name + " watermark: run python change_log.py, then a full run first")
+
+        start_position = get_log_position(mycursor)
+        authors = get_changed_authors(mycursor, last_position, start_position)
+        mycursor.close()
+        print("Refreshing " + str(len(authors)) + " author(s) with changed publications")
+
+        failures = finger_print_authors_bulk(mydb, authors, replace=True)
+    else:
+        if args.retry_failed:
+            authors = read_failed_author_ids()
+            print("Retrying " + str(len(authors)) + " failed author(s)")
+        else:
+            # Changes logged after this point are picked up by the next --incremental run
+            start_position = get_start_position(mydb)
+
+            mycursor = mydb.cursor()
+            mycursor.execute("SELECT id FROM Author")
+            authors = [author_t[0] for author_t in mycursor.fetchall()]
+            mycursor.close()
+
+        if args.mode == 'per-author' and args.workers > 1:
+            failures = finger_print_authors_parallel(authors, args.workers)
+        elif args.mode == 'bulk':
+            failures = finger_print_authors_bulk(mydb, authors)
+        else:
+            failures = finger_print_authors(mydb, authors)
 
-    if au_i % 300 == 0:
-        print("On " + str(au_i) + "th author")
+    mycursor = mydb.cursor()
+    if start_position is not None:
+        set_watermark(mycursor, refresh_name, start_position)
+        prune_change_log(mycursor)
+    bump_data_version(mycursor, "Author_FoS")
+    mydb.commit()
+    mycursor.close()
 
-    au_i += 1
+    mydb.close()
 
-mydb.commit()
+    write_failures(failures)
+    print(str(len(failures)) + " author(s) failed" + (", see " + failures_file if len(failures) > 0 else ""))
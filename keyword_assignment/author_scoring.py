@@ -0,0 +1,128 @@
+"""
+Vectorized version of the author keyword scoring in assign_researcher_kwds.py.
+
+Publication keyword scores are transformed with the softmax-like function f:
+    w_pk = a^(score_pk) / sum_k' { a^(score_pk') }
+
+and an author's score for keyword k is the citation-weighted sum over the
+author's publications p:
+    score_k = sum_p { citation_p * w_pk }
+
+Both steps run for all publications / a block of authors at once as sparse
+group-by operations, instead of one SQL aggregation per author.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+
+def get_id_index(ids, query_ids):
+    """
+    Arguments:
+    - ids: sorted array of unique ids
+    - query_ids: array of ids to look up
+
+    Returns: (idx, found) where ids[idx[i]] == query_ids[i] wherever found[i].
+    """
+    idx = np.searchsorted(ids, query_ids)
+    idx[idx == len(ids)] = 0
+    found = ids[idx] == query_ids if len(ids) > 0 else np.zeros(len(query_ids), dtype=bool)
+
+    return idx, found
+
+
+def build_pub_keyword_matrix(pfs_pub_ids, pfs_fos_ids, pfs_scores, pub_ids, pub_citations, fos_ids, exp_base):
+    """
+    Builds the publication x keyword matrix of citation-weighted scores
+
+    Arguments:
+    - pfs_pub_ids, pfs_fos_ids, pfs_scores: Publication_FoS columns
+    - pub_ids: sorted unique ids of the publications to score
+    - pub_citations: citation count of each of pub_ids
+    - fos_ids: sorted unique ids of the keywords in the FoS table
+    - exp_base: base a of the softmax-like transform
+
+    Returns: csr_matrix of shape (len(pub_ids), len(fos_ids)) with
+    citation_p * w_pk for every Publication_FoS row. Rows of publications
+    not in pub_ids are left out; rows of keywords not in fos_ids are left
+    out of the matrix but still count towards their publication's sum,
+    as in the per-author SQL.
+    """
+    pub_idx, pub_found = get_id_index(pub_ids, pfs_pub_ids)
+    pub_idx = pub_idx[pub_found]
+    weights = np.power(exp_base, pfs_scores[pub_found].astype(np.float64))
+
+    weight_sums = np.bincount(pub_idx, weights=weights, minlength=len(pub_ids))
+
+    fos_idx, fos_found = get_id_index(fos_ids, pfs_fos_ids[pub_found])
+    pub_idx = pub_idx[fos_found]
+    scores = pub_citations[pub_idx] * weights[fos_found] / weight_sums[pub_idx]
+
+    pub_keyword_matrix = sp.csr_matrix((scores, (pub_idx, fos_idx[fos_found])), shape=(len(pub_ids), len(fos_ids)))
+    pub_keyword_matrix.sum_duplicates()
+    return pub_keyword_matrix
+
+
+def build_author_pub_matrix(pa_author_ids, pa_pub_ids, author_ids, pub_ids):
+    """
+    Arguments:
+    - pa_author_ids, pa_pub_ids: Publication_Author columns
+    - author_ids: ids of the authors to score (matrix rows, in this order)
+    - pub_ids: sorted unique publication ids (matrix columns)
+
+    Returns: binary csr_matrix of shape (len(author_ids), len(pub_ids));
+    repeated Publication_Author rows count once.
+    """
+    author_order = np.argsort(author_ids, kind='stable')
+    sorted_author_ids = np.asarray(author_ids)[author_order]
+
+    author_idx, author_found = get_id_index(sorted_author_ids, pa_author_ids)
+    pub_idx, pub_found = get_id_index(pub_ids, pa_pub_ids)
+    found = author_found & pub_found
+
+    rows = author_order[author_idx[found]]
+    cols = pub_idx[found]
+
+    author_pub_matrix = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(author_ids), len(pub_ids)))
+    author_pub_matrix.sum_duplicates()
+    author_pub_matrix.data[:] = 1
+    return author_pub_matrix
+
+
+def score_authors(author_pub_matrix, pub_keyword_matrix):
+    """
+    Sums the keyword scores of every author's publications
+
+    Arguments:
+    - author_pub_matrix: binary authors x publications csr_matrix
+    - pub_keyword_matrix: publications x keywords csr_matrix from
+      build_pub_keyword_matrix
+
+    Returns: authors x keywords csr_matrix with sorted indices. Unlike
+    author_pub_matrix @ pub_keyword_matrix, keywords whose scores sum to 0
+    (e.g. only uncited papers) stay in the matrix, as they do in the SQL
+    aggregation.
+    """
+    num_authors = author_pub_matrix.shape[0]
+    num_keywords = pub_keyword_matrix.shape[1]
+
+    author_pub_matrix = author_pub_matrix.tocsr()
+    pair_authors = np.repeat(np.arange(num_authors), np.diff(author_pub_matrix.indptr))
+    pair_pubs = author_pub_matrix.indices
+
+    # Expand each (author, publication) pair into the publication's keyword entries
+    pub_lens = np.diff(pub_keyword_matrix.indptr)[pair_pubs]
+    total = int(pub_lens.sum())
+    pair_starts = np.repeat(pub_keyword_matrix.indptr[pair_pubs] - np.cumsum(pub_lens) + pub_lens, pub_lens)
+    entries = pair_starts + np.arange(total)
+
+    entry_authors = np.repeat(pair_authors, pub_lens)
+    keys = entry_authors.astype(np.int64) * num_keywords + pub_keyword_matrix.indices[entries]
+
+    # Group by (author, keyword)
+    unique_keys, key_idx = np.unique(keys, return_inverse=True)
+    sums = np.bincount(key_idx, weights=pub_keyword_matrix.data[entries], minlength=len(unique_keys))
+
+    indptr = np.zeros(num_authors + 1, dtype=np.int64)
+    np.cumsum(np.bincount(unique_keys // num_keywords, minlength=num_authors), out=indptr[1:])
+
+    return sp.csr_matrix((sums, unique_keys % num_keywords, indptr), shape=(num_authors, num_keywords))
@@ -0,0 +1,84 @@
+"""
+Builds the golden-keyword matcher once and saves it, so assign_paper_kwds.py
+loads it from disk instead of rebuilding the trie and pattern in every
+process.
+
+Usage:
+    python build_keyword_matcher.py
+    python build_keyword_matcher.py --engine regex
+
+Rebuild whenever golden_words.csv or springer_word_to_id.pickle change.
+
+Only the aho-corasick file loads without a rebuild. A saved regex matcher
+is a pickled re.Pattern, which the re module recompiles on load (about 3s
+for 30k keywords against 0.3s for aho-corasick), so it only saves building
+the trie and pattern string.
+"""
+import argparse
+import pandas as pd
+
+from trie import construct_trie, construct_matcher, save_matcher, AhoCorasick
+from utils import read_pickle_file, standardize_non_ascii
+
+
+data_root_dir = 'setup_data/'
+
+ids_file = data_root_dir + "springer_word_to_id.pickle"
+golden_keywords_file = data_root_dir + "golden_words.csv"
+
+
+def get_matcher_file(engine):
+    return data_root_dir + "keyword_matcher_" + engine + ".bin"
+
+
+def get_keyword_id(word_to_id, keyword):
+    """
+    Returns: FoS id of a lowercased keyword, trying its standardized form
+    if the keyword itself is not in word_to_id, or None.
+    """
+    if keyword in word_to_id:
+        return word_to_id[keyword]
+    return word_to_id.get(standardize_non_ascii(keyword))
+
+
+def build_keyword_matcher(engine='aho-corasick'):
+    """
+    Builds a matcher for the golden keywords.
+
+    Returns: matcher from trie.construct_matcher. An Aho-Corasick matcher
+    also carries the FoS id of every keyword (see AhoCorasick.set_keyword_ids).
+    """
+    # Keyword set formed from the set intersection of
+    # - Springer set: parse papers for author-labeled keywords and keep those
+    # with freq >= 5
+    # - EmbedRank set: Use EmbedRank to extract keywords from entire cs corpus.
+    golden_keywords = pd.read_csv(golden_keywords_file)
+    golden_keywords = set(golden_keywords['word'])
+
+    keywords_trie = construct_trie(golden_keywords)
+    matcher = construct_matcher(keywords_trie, engine)
+
+    if isinstance(matcher, AhoCorasick):
+        word_to_id = read_pickle_file(ids_file)
+        matcher.set_keyword_ids(lambda keyword: get_keyword_id(word_to_id, keyword))
+
+    return matcher
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and save the golden-keyword matcher")
+    parser.add_argument('--engine', choices=['regex', 'aho-corasick'], default='aho-corasick',
+                        help="only the aho-corasick file loads without a rebuild; a saved regex "
+                             "matcher is recompiled on every load")
+    args = parser.parse_args()
+
+    if args.engine == 'regex':
+        print("WARNING: a saved regex matcher is recompiled on every load (seconds for large "
+              "keyword sets); use --engine aho-corasick for fast loading")
+
+    print("Building " + args.engine + " keyword matcher")
+    matcher = build_keyword_matcher(args.engine)
+
+    matcher_file = get_matcher_file(args.engine)
+    save_matcher(matcher, matcher_file)
+    print("Saved keyword matcher to " + matcher_file)
@@ -0,0 +1,189 @@
+"""
+Change tracking for incremental refreshes of derived tables.
+
+Triggers append the id of every publication whose keywords (Publication_FoS),
+authors (Publication_Author) or citation count change to
+Publication_Change_Log. Publication_Author changes also log the author id,
+so authors who lose a publication are refreshed too. A refresh job remembers the last log id it has
+processed in Refresh_Watermark, so its next run only looks at newer changes.
+
+Jobs that rewrite a table read by expert ranking also bump that table's
+version in Data_Version when they finish, which invalidates cached ranking
+results (see rank_researchers.py).
+
+Usage (once, from keyword_assignment/):
+    python change_log.py
+"""
+import mysql.connector
+
+
+change_log_table = "Publication_Change_Log"
+watermark_table = "Refresh_Watermark"
+data_version_table = "Data_Version"
+
+
+def create_data_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS """ + data_version_table + """ (
+            name VARCHAR(64) PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def bump_data_version(cur, name):
+    """
+    Records that table name was refreshed (commit afterwards).
+    """
+    create_data_version_table(cur)
+    cur.execute("INSERT INTO " + data_version_table + " (name, version) VALUES (%s, 1)"
+                + " ON DUPLICATE KEY UPDATE version = version + 1", (name,))
+
+
+def get_data_version(cur):
+    """
+    Returns: tuple of (name, version) pairs of every refreshed table.
+    """
+    cur.execute("SELECT name, version FROM " + data_version_table + " ORDER BY name")
+    return tuple(cur.fetchall())
+
+
+def get_trigger_sqls():
+    """
+    Returns: dict of trigger name -> CREATE TRIGGER statement.
+    """
+    log_sql = "INSERT INTO " + change_log_table + " (publication_id, author_id) VALUES ({}, {})"
+
+    def log_row(row, pub_col, author_col):
+        return log_sql.format(row + "." + pub_col, row + "." + author_col if author_col is not None else "NULL")
+
+    trigger_sqls = {}
+    for table, pub_col, author_col in [("Publication_FoS", "publication_id", None),
+                                       ("Publication_Author", "publication_mag_id", "author_id")]:
+        trigger_sqls[table + "_insert_log"] = "CREATE TRIGGER " + table + "_insert_log AFTER INSERT ON " + table \
+            + " FOR EACH ROW " + log_row("NEW", pub_col, author_col)
+        trigger_sqls[table + "_delete_log"] = "CREATE TRIGGER " + table + "_delete_log AFTER DELETE ON " + table \
+            + " FOR EACH ROW " + log_row("OLD", pub_col, author_col)
+        trigger_sqls[table + "_update_log"] = "CREATE TRIGGER " + table + "_update_log AFTER UPDATE ON " + table \
+            + " FOR EACH ROW BEGIN " + log_row("OLD", pub_col, author_col) + "; " \
+            + log_row("NEW", pub_col, author_col) + "; END"
+
+    trigger_sqls["Publication_citation_log"] = "CREATE TRIGGER Publication_citation_log AFTER UPDATE ON Publication" \
+        + " FOR EACH ROW BEGIN IF NOT (NEW.citation <=> OLD.citation) THEN " + log_row("NEW", "id", None) \
+        + "; END IF; END"
+
+    return trigger_sqls
+
+
+def setup_change_log(cur):
+    """
+    Creates the change log, watermark and data version tables and the
+    triggers (replacing existing triggers of the same name).
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS """ + change_log_table + """ (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            publication_id BIGINT NOT NULL,
+            author_id BIGINT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Logs created before author ids were logged
+    cur.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'author_id'
+    """, (change_log_table,))
+    if cur.fetchone()[0] == 0:
+        cur.execute("ALTER TABLE " + change_log_table + " ADD COLUMN author_id BIGINT NULL AFTER publication_id")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS """ + watermark_table + """ (
+            name VARCHAR(64) PRIMARY KEY,
+            last_change_id BIGINT NOT NULL
+        )
+    """)
+
+    create_data_version_table(cur)
+
+    for trigger_name, trigger_sql in get_trigger_sqls().items():
+        cur.execute("DROP TRIGGER IF EXISTS " + trigger_name)
+        cur.execute(trigger_sql)
+
+
+def get_log_position(cur):
+    """
+    Returns: id of the newest change log entry, 0 if the log is empty.
+    """
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM " + change_log_table)
+    return cur.fetchone()[0]
+
+
+def get_watermark(cur, name):
+    """
+    Returns: last change log id processed by the refresh job name, or None
+    if the job never ran.
+    """
+    cur.execute("SELECT last_change_id FROM " + watermark_table + " WHERE name = %s", (name,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def set_watermark(cur, name, last_change_id):
+    cur.execute("INSERT INTO " + watermark_table + " (name, last_change_id) VALUES (%s, %s)"
+                + " ON DUPLICATE KEY UPDATE last_change_id = VALUES(last_change_id)", (name, last_change_id))
+
+
+def get_changed_authors(cur, after_change_id, upto_change_id):
+    """
+    Returns: sorted ids of the authors (in the Author table) of every
+    publication logged in (after_change_id, upto_change_id], plus the
+    logged authors of changed Publication_Author rows (who may no longer
+    be linked to the publication).
+    """
+    cur.execute("""
+        SELECT Author.id
+        FROM (
+            SELECT author_id
+            FROM (
+                SELECT DISTINCT publication_id
+                FROM """ + change_log_table + """
+                WHERE id > %s AND id <= %s
+            ) AS changed_pubs
+            JOIN Publication_Author ON publication_mag_id = changed_pubs.publication_id
+
+            UNION
+
+            SELECT author_id
+            FROM """ + change_log_table + """
+            WHERE id > %s AND id <= %s AND author_id IS NOT NULL
+        ) AS changed_authors
+        JOIN Author ON Author.id = changed_authors.author_id
+        ORDER BY Author.id
+    """, (after_change_id, upto_change_id, after_change_id, upto_change_id))
+
+    return [t[0] for t in cur.fetchall()]
+
+
+def prune_change_log(cur):
+    """
+    Deletes log entries every refresh job has processed.
+    """
+    cur.execute("SELECT MIN(last_change_id) FROM " + watermark_table)
+    min_watermark = cur.fetchone()[0]
+    if min_watermark is not None:
+        cur.execute("DELETE FROM " + change_log_table + " WHERE id <= %s", (min_watermark,))
+
+
+if __name__ == '__main__':
+    from assign_researcher_kwds import db_config
+
+    mydb = mysql.connector.connect(**db_config)
+    mycursor = mydb.cursor()
+
+    setup_change_log(mycursor)
+    mydb.commit()
+    print("Created " + change_log_table + ", " + watermark_table + ", " + data_version_table + " and " + str(len(get_trigger_sqls())) + " triggers")
+
+    mycursor.close()
+    mydb.close()
@@ -0,0 +1,257 @@
+"""
+Persistent cache of sentence embeddings, so repeated texts (recurring
+keywords, re-runs of a script) skip the model entirely.
+
+Entries are keyed by (model name, hash of the normalized text) and stored
+in a SQLite file. An in-memory LRU sits in front of it, and the file is
+kept under max_entries by evicting the least recently used rows.
+
+Usage:
+    cache = EmbeddingCache(model_name='bert-base-nli-mean-tokens')
+    encoder = CachedEncoder(cache, lambda: SentenceTransformer('bert-base-nli-mean-tokens'))
+    embs = encoder.encode(['machine learning', 'data mining'])
+"""
+import os
+import time
+import sqlite3
+import threading
+import hashlib
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+
+
+default_cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup_data', 'embedding_cache.sqlite')
+
+# Maximum seconds between writes of the last_used times of memory hits
+touch_interval = 60
+
+
+def normalize_cache_text(text):
+    """
+    Normalizes text before hashing so that texts the model tokenizes the same
+    way (different unicode forms, extra whitespace) share one entry.
+    """
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def hash_cache_text(text):
+    return hashlib.blake2b(normalize_cache_text(text).encode('utf-8'), digest_size=16).digest()
+
+
+class EmbeddingCache():
+    """
+    SQLite-backed embedding cache for one model.
+
+    Arguments:
+    - cache_file: path of the SQLite file (created if missing)
+    - model_name: model the embeddings come from, part of every key
+    - max_entries: rows kept on disk across all models; least recently used
+      rows are evicted beyond this
+    - memory_entries: size of the in-memory LRU front
+
+    A cache object may be shared between threads; its methods serialize on
+    an internal lock.
+    """
+
+    def __init__(self, cache_file=default_cache_file, model_name='bert-base-nli-mean-tokens',
+                 max_entries=2000000, memory_entries=50000):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.RLock()
+
+        # Memory hits whose last_used on disk is not updated yet
+        self.pending_touches = set()
+        self.touched_at = time.time()
+
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        # Several processes may share one cache file
+        self.conn = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT,
+                text_hash BLOB,
+                embedding BLOB,
+                last_used REAL,
+                PRIMARY KEY(model, text_hash)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _remember(self, text_hash, emb):
+        self.memory[text_hash] = emb
+        self.memory.move_to_end(text_hash)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, text_hashes):
+        """
+        Returns: list with the cached embedding of each hash, or None where
+        the hash is not cached.
+        """
+        with self.lock:
+            return self._get_many(text_hashes)
+
+    def _get_many(self, text_hashes):
+        res = [None] * len(text_hashes)
+        disk_lookups = {}
+
+        for i, text_hash in enumerate(text_hashes):
+            if text_hash in self.memory:
+                self.memory.move_to_end(text_hash)
+                res[i] = self.memory[text_hash]
+                self.pending_touches.add(text_hash)
+            else:
+                disk_lookups.setdefault(text_hash, []).append(i)
+
+        if len(disk_lookups) == 0:
+            if time.time() - self.touched_at >= touch_interval:
+                self.touch([])
+            return res
+
+        found_hashes = []
+        lookup_hashes = list(disk_lookups.keys())
+
+        # Stay under SQLite's limit on query parameters
+        for start in range(0, len(lookup_hashes), 500):
+            hash_chunk = lookup_hashes[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ("
+                + ",".join(["?"] * len(hash_chunk)) + ")",
+                [self.model_name] + hash_chunk).fetchall()
+
+            for text_hash, emb_bytes in rows:
+                emb = np.frombuffer(emb_bytes, dtype=np.float32)
+                self._remember(text_hash, emb)
+                found_hashes.append(text_hash)
+                for i in disk_lookups[text_hash]:
+                    res[i] = emb
+
+        if len(found_hashes) > 0:
+            self.touch(found_hashes)
+
+        return res
+
+    def touch(self, text_hashes):
+        """
+        Sets last_used of text_hashes and of the pending memory hits, so
+        entries served from memory are not evicted from disk as unused.
+        """
+        self.touched_at = time.time()
+        touch_hashes = self.pending_touches.union(text_hashes)
+        self.pending_touches = set()
+        if len(touch_hashes) == 0:
+            return
+
+        self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                              [(self.touched_at, self.model_name, text_hash) for text_hash in touch_hashes])
+        self.conn.commit()
+
+    def put_many(self, text_hashes, embs):
+        """
+        Stores one embedding per hash, then evicts old rows if the cache is full.
+        """
+        with self.lock:
+            self._put_many(text_hashes, embs)
+
+    def _put_many(self, text_hashes, embs):
+        now = time.time()
+        rows = []
+        for text_hash, emb in zip(text_hashes, embs):
+            emb = np.asarray(emb, dtype=np.float32)
+            self._remember(text_hash, emb)
+            rows.append((self.model_name, text_hash, emb.tobytes(), now))
+
+        self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+        # Over-counts replaced rows; evict() recounts before deleting anything
+        self.num_entries += len(rows)
+        self.conn.commit()
+
+        if self.num_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used rows down to 90% of max_entries.
+        """
+        self.touch([])
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        num_evicted = self.num_entries - int(0.9 * self.max_entries)
+        if num_evicted <= 0:
+            return
+
+        self.conn.execute("""
+            DELETE FROM embeddings WHERE (model, text_hash) IN
+            (SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)
+        """, (num_evicted,))
+        self.conn.commit()
+        self.num_entries -= num_evicted
+
+    def close(self):
+        with self.lock:
+            self.touch([])
+            self.conn.close()
+
+
+class CachedEncoder():
+    """
+    Wraps a model's encode() with an EmbeddingCache.
+
+    Arguments:
+    - cache: EmbeddingCache for the model
+    - get_model: zero-argument function returning an object with
+      encode(list_of_texts) -> array, e.g. a SentenceTransformer. It is only
+      called on the first cache miss and the model is kept, so fully cached
+      calls never load the model and later misses reuse it.
+    """
+
+    def __init__(self, cache, get_model):
+        self.cache = cache
+        self.get_model = get_model
+
+        self.model = None
+        self.model_lock = threading.Lock()
+
+    def load_model(self):
+        # Encoders may be shared between threads, load the model only once
+        with self.model_lock:
+            if self.model is None:
+                self.model = self.get_model()
+            return self.model
+
+    def encode(self, texts):
+        """
+        Returns: (len(texts), dim) float32 array of embeddings.
+        """
+        text_hashes = [hash_cache_text(text) for text in texts]
+        embs = self.cache.get_many(text_hashes)
+
+        # Encode each missing text once, even if it is repeated
+        missing = {}
+        for i, emb in enumerate(embs):
+            if emb is None:
+                missing.setdefault(text_hashes[i], []).append(i)
+
+        if len(missing) > 0:
+            missing_hashes = list(missing.keys())
+            missing_texts = [texts[missing[text_hash][0]] for text_hash in missing_hashes]
+            missing_embs = np.asarray(self.load_model().encode(missing_texts), dtype=np.float32)
+
+            self.cache.put_many(missing_hashes, missing_embs)
+            for text_hash, emb in zip(missing_hashes, missing_embs):
+                for i in missing[text_hash]:
+                    embs[i] = emb
+
+        if len(embs) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        return np.vstack(embs)
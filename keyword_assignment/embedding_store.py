@@ -0,0 +1,406 @@
+"""
+On-disk embedding store that processes open by memory-mapping instead of
+unpickling, so start-up takes milliseconds and worker processes share the
+same pages through the OS page cache.
+
+A store is a directory holding:
+    - embeddings.npy: (count, dim) matrix, row i is the embedding of ids[i]
+    - ids.npy: int64 id of each row
+    - id_order.npy: argsort of ids, for id -> row lookups by binary search
+    - text_hashes.npy: 16-byte hash of the text each row was encoded from
+      (empty for rows converted from pickles)
+    - meta.json: format version, dtype, dim, count and model name
+
+update_embedding_store replaces changed rows in place and appends new ones
+to the end of the files, so a corpus can be re-embedded incrementally (see
+store_paper_embeddings.py) without copying the whole store; meta.json is
+written last, and readers only use the first meta['count'] rows, so an
+interrupted update leaves a valid store.
+
+Usage (convert existing pickles):
+    python embedding_store.py setup_data/SB_paper_embeddings.pickle setup_data/SB_paper_embeddings \\
+        --ids setup_data/SB_paper_embedding_mag_ids.pickle
+    python embedding_store.py setup_data/springer_keyword_embs.pickle setup_data/springer_keyword_embs --normalize
+"""
+import os
+import io
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import numpy.linalg as la
+
+from utils import read_pickle_file
+
+
+store_format_version = 1
+default_model_name = 'bert-base-nli-mean-tokens'
+text_hash_dtype = 'S16'
+
+# Rows copied per step when rewriting a store
+copy_chunk_size = 65536
+
+
+def hash_text(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class EmbeddingStore():
+    """
+    Read-only view of an embedding store directory.
+
+    Arguments:
+    - store_dir: directory written by write_embedding_store
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != store_format_version:
+            raise ValueError("Unsupported embedding store version " + str(self.meta['version'])
+                             + " in " + store_dir)
+
+        # Rows past count belong to an update that did not finish
+        count = self.meta['count']
+        self.embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r')[:count]
+        self.ids = np.load(os.path.join(store_dir, 'ids.npy'), mmap_mode='r')[:count]
+        self.id_order = np.load(os.path.join(store_dir, 'id_order.npy'), mmap_mode='r')
+        if len(self.id_order) != count:
+            self.id_order = np.argsort(self.ids, kind='stable')
+        self.sorted_ids = self.ids[self.id_order]
+
+        text_hashes_file = os.path.join(store_dir, 'text_hashes.npy')
+        if os.path.exists(text_hashes_file):
+            self.text_hashes = np.load(text_hashes_file, mmap_mode='r')[:count]
+        else:
+            self.text_hashes = np.zeros(len(self.ids), dtype=text_hash_dtype)
+
+    def __len__(self):
+        return self.meta['count']
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    @property
+    def model_name(self):
+        return self.meta['model_name']
+
+    def find_rows(self, ids):
+        """
+        Returns: (rows, found) arrays; rows[i] is the row of ids[i] where
+        found[i] is True and meaningless otherwise.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.sorted_ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+
+        pos = np.searchsorted(self.sorted_ids, ids)
+        pos = np.minimum(pos, len(self.sorted_ids) - 1)
+
+        return self.id_order[pos], self.sorted_ids[pos] == ids
+
+    def get_rows(self, ids):
+        """
+        Returns: row index of each id. Raises KeyError for unknown ids.
+        """
+        rows, found = self.find_rows(ids)
+        if not np.all(found):
+            missing = np.asarray(ids)[~found]
+            raise KeyError("Ids not in embedding store: " + str(missing[:10].tolist()))
+
+        return rows
+
+    def get(self, ids):
+        """
+        Returns: (len(ids), dim) array with the embedding of each id.
+        """
+        return self.embeddings[self.get_rows(ids)]
+
+
+def _check_rows(ids, embeddings, text_hashes):
+    if embeddings.ndim != 2 or len(embeddings) != len(ids):
+        raise ValueError("Expected one embedding row per id, got " + str(embeddings.shape)
+                         + " embeddings for " + str(len(ids)) + " ids")
+    if len(text_hashes) != len(ids):
+        raise ValueError("Expected one text hash per id, got " + str(len(text_hashes))
+                         + " hashes for " + str(len(ids)) + " ids")
+
+
+def _make_tmp_dir(store_dir):
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    return tmp_dir
+
+
+def _finish_store(tmp_dir, store_dir, ids, embeddings_dtype, dim, model_name, text_hashes):
+    np.save(os.path.join(tmp_dir, 'ids.npy'), ids)
+    np.save(os.path.join(tmp_dir, 'id_order.npy'), np.argsort(ids, kind='stable'))
+    np.save(os.path.join(tmp_dir, 'text_hashes.npy'), text_hashes)
+
+    meta = {
+        'version': store_format_version,
+        'dtype': str(embeddings_dtype),
+        'dim': int(dim),
+        'count': int(len(ids)),
+        'model_name': model_name
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # The old store is renamed aside and deleted only once the new one is in
+    # place, so readers never find store_dir missing for longer than the
+    # rename. An interrupted swap leaves the old store at old_dir.
+    old_dir = store_dir.rstrip('/') + '.old'
+    if os.path.exists(old_dir):
+        if os.path.exists(store_dir):
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(old_dir, store_dir)
+
+    if os.path.exists(store_dir):
+        os.rename(store_dir, old_dir)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        if os.path.exists(old_dir):
+            os.rename(old_dir, store_dir)
+        raise
+
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def write_embedding_store(store_dir, ids, embeddings, model_name=default_model_name, text_hashes=None):
+    """
+    Writes ids and embeddings as a new store, replacing any store at store_dir
+
+    Arguments:
+    - store_dir: output directory
+    - ids: sequence of integer ids, one per embedding row
+    - embeddings: (count, dim) array
+    - model_name: name of the model the embeddings come from
+    - text_hashes: optional hash_text() of the text behind each row
+
+    The store is written to a temporary directory first and then moved into
+    place, so readers never see a half-written store.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    embeddings = np.asarray(embeddings)
+    if text_hashes is None:
+        text_hashes = np.zeros(len(ids), dtype=text_hash_dtype)
+    text_hashes = np.asarray(text_hashes, dtype=text_hash_dtype)
+
+    _check_rows(ids, embeddings, text_hashes)
+
+    tmp_dir = _make_tmp_dir(store_dir)
+    np.save(os.path.join(tmp_dir, 'embeddings.npy'), embeddings)
+    _finish_store(tmp_dir, store_dir, ids, embeddings.dtype, embeddings.shape[1], model_name, text_hashes)
+
+
+def _write_meta(store_dir, meta):
+    tmp_file = os.path.join(store_dir, 'meta.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_file, os.path.join(store_dir, 'meta.json'))
+
+
+def _replace_npy(npy_file, arr):
+    tmp_file = npy_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_file, npy_file)
+
+
+def _append_npy_rows(npy_file, num_rows, rows):
+    """
+    Appends rows after the first num_rows rows of a .npy file, in place
+
+    Returns: False, leaving the file unchanged, if its header has no room
+    for the new shape.
+    """
+    with open(npy_file, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            write_header = np.lib.format.write_array_header_1_0
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            write_header = np.lib.format.write_array_header_2_0
+        else:
+            return False
+        data_offset = f.tell()
+
+        if fortran_order or dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:]:
+            return False
+
+        # np.save leaves room in the header for the row count to grow
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (num_rows + len(rows),) + tuple(shape[1:])})
+        if len(header.getvalue()) != data_offset:
+            return False
+
+        # Rows first, then the header, so the file is never shorter than its shape
+        f.seek(data_offset + num_rows * dtype.itemsize * int(np.prod(shape[1:])))
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.truncate()
+        f.flush()
+
+        f.seek(0)
+        f.write(header.getvalue())
+
+    return True
+
+
+def _open_text_hashes(store_dir, count):
+    """
+    Returns: writable memmap of the store's text hashes (created for stores
+    converted without them).
+    """
+    text_hashes_file = os.path.join(store_dir, 'text_hashes.npy')
+    if not os.path.exists(text_hashes_file):
+        _replace_npy(text_hashes_file, np.zeros(count, dtype=text_hash_dtype))
+
+    return np.load(text_hashes_file, mmap_mode='r+')
+
+
+def update_text_hashes(store_dir, ids, text_hashes):
+    """
+    Records new text hashes for ids already in the store, in place (the
+    embeddings are left untouched).
+    """
+    store = EmbeddingStore(store_dir)
+    rows = store.get_rows(ids)
+    count = len(store)
+    del store
+
+    stored_hashes = _open_text_hashes(store_dir, count)
+    stored_hashes[rows] = np.asarray(text_hashes, dtype=text_hash_dtype)
+    stored_hashes.flush()
+
+
+def update_embedding_store(store_dir, ids, embeddings, text_hashes, model_name=default_model_name):
+    """
+    Replaces the rows of ids already in the store and appends the others
+
+    Arguments:
+    - store_dir: store directory; a new store is written if it does not exist
+    - ids: sequence of distinct integer ids
+    - embeddings: (len(ids), dim) array
+    - text_hashes: hash_text() of the text behind each row
+    - model_name: used when creating a new store; must match an existing one
+
+    Existing rows are overwritten through a memmap and new rows appended to
+    the files, so the cost is proportional to the number of ids, not to the
+    size of the store. meta.json (the row count) is replaced last.
+    """
+    if not os.path.exists(store_dir):
+        write_embedding_store(store_dir, ids, embeddings, model_name, text_hashes)
+        return
+
+    ids = np.asarray(ids, dtype=np.int64)
+    embeddings = np.asarray(embeddings)
+    text_hashes = np.asarray(text_hashes, dtype=text_hash_dtype)
+    _check_rows(ids, embeddings, text_hashes)
+
+    store = EmbeddingStore(store_dir)
+    if store.model_name != model_name:
+        raise ValueError("Store " + store_dir + " holds " + store.model_name
+                         + " embeddings, cannot add " + model_name + " embeddings")
+    if len(ids) > 0 and embeddings.shape[1] != store.dim:
+        raise ValueError("Store " + store_dir + " has dim " + str(store.dim)
+                         + ", got embeddings of dim " + str(embeddings.shape[1]))
+
+    rows, found = store.find_rows(ids)
+    num_old = len(store)
+    embeddings = embeddings.astype(store.embeddings.dtype, copy=False)
+    old_ids = np.asarray(store.ids)
+    meta = dict(store.meta)
+    del store
+
+    embeddings_file = os.path.join(store_dir, 'embeddings.npy')
+
+    # Changed rows, then their hashes: an interrupted update at worst leaves
+    # a new embedding with its old hash, which is re-encoded on the next run
+    if np.any(found):
+        stored_embeddings = np.load(embeddings_file, mmap_mode='r+')
+        stored_embeddings[rows[found]] = embeddings[found]
+        stored_embeddings.flush()
+        del stored_embeddings
+
+        stored_hashes = _open_text_hashes(store_dir, num_old)
+        stored_hashes[rows[found]] = text_hashes[found]
+        stored_hashes.flush()
+        del stored_hashes
+
+    if np.all(found):
+        return
+
+    new_ids = np.concatenate([old_ids, ids[~found]])
+    new_text_hashes = np.concatenate([np.asarray(_open_text_hashes(store_dir, num_old)[:num_old]),
+                                      text_hashes[~found]])
+
+    if not _append_npy_rows(embeddings_file, num_old, embeddings[~found]):
+        # No room to grow the header in place: rewrite the embeddings file
+        stored_embeddings = np.load(embeddings_file, mmap_mode='r')[:num_old]
+        tmp_file = embeddings_file + '.tmp'
+        new_embeddings = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=stored_embeddings.dtype,
+                                                   shape=(len(new_ids), meta['dim']))
+        for start in range(0, num_old, copy_chunk_size):
+            end = min(start + copy_chunk_size, num_old)
+            new_embeddings[start:end] = stored_embeddings[start:end]
+        new_embeddings[num_old:] = embeddings[~found]
+        new_embeddings.flush()
+        del new_embeddings, stored_embeddings
+        os.replace(tmp_file, embeddings_file)
+
+    _replace_npy(os.path.join(store_dir, 'text_hashes.npy'), new_text_hashes)
+    _replace_npy(os.path.join(store_dir, 'ids.npy'), new_ids)
+    _replace_npy(os.path.join(store_dir, 'id_order.npy'), np.argsort(new_ids, kind='stable'))
+
+    meta['count'] = int(len(new_ids))
+    _write_meta(store_dir, meta)
+
+
+def convert_pickles(embeddings_file, store_dir, ids_file=None, model_name=default_model_name, normalize=False):
+    """
+    Converts a pickled embedding matrix (and optional pickled id list) to a store
+
+    If ids_file is None the row index is used as the id, which matches how
+    keyword embeddings are indexed by keyword id.
+    """
+    embeddings = np.asarray(read_pickle_file(embeddings_file))
+    if ids_file is not None:
+        ids = read_pickle_file(ids_file)
+    else:
+        ids = np.arange(len(embeddings))
+
+    if normalize:
+        embeddings = embeddings / la.norm(embeddings, axis=1)[:, None]
+
+    write_embedding_store(store_dir, ids, embeddings, model_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert pickled embeddings to an embedding store")
+    parser.add_argument('embeddings_file', help="pickled (count, dim) embedding matrix")
+    parser.add_argument('store_dir', help="output store directory")
+    parser.add_argument('--ids', dest='ids_file', default=None,
+                        help="pickled list of ids, one per row (default: row index)")
+    parser.add_argument('--model-name', default=default_model_name)
+    parser.add_argument('--normalize', action='store_true',
+                        help="store unit-length embeddings")
+    args = parser.parse_args()
+
+    convert_pickles(args.embeddings_file, args.store_dir, args.ids_file, args.model_name, args.normalize)
+
+    store = EmbeddingStore(args.store_dir)
+    print("Wrote " + str(len(store)) + " embeddings of dim " + str(store.dim) + " to " + args.store_dir)
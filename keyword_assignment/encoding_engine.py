@@ -0,0 +1,141 @@
+"""
+Sentence-BERT encoding engine that runs well on CPU-only machines.
+
+- Texts are bucketed by length before batching, so each batch holds texts
+  of similar length and little time is spent on padding tokens.
+- With num_workers > 1 the batches are spread over a pool of processes,
+  each with a fixed number of torch threads (num_workers *
+  threads_per_worker should not exceed the number of cores).
+- The model can optionally be int8-quantized (dynamic quantization of the
+  Linear layers) or loaded through an ONNX backend.
+
+Checkpointing is left to the caller: encode() returns one chunk at a time
+and store_paper_embeddings.py writes each chunk to the embedding store.
+"""
+import multiprocessing
+import numpy as np
+
+
+default_model_name = 'bert-base-nli-mean-tokens'
+
+
+def get_length_buckets(texts, batch_size):
+    """
+    Groups text indices into batches of texts with similar length
+
+    Arguments:
+    - texts: list of strings
+    - batch_size: maximum number of texts per batch
+
+    Returns: list of lists of indices into texts, longest texts first.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def load_model(model_name=default_model_name, device='cpu', num_threads=None, quantize=False, backend='torch'):
+    """
+    Loads a SentenceTransformer for encoding
+
+    Arguments:
+    - model_name: sentence-transformers model name
+    - device: 'cpu' or 'cuda'
+    - num_threads: torch intra-op threads for this process (None = torch default)
+    - quantize: apply int8 dynamic quantization to Linear layers (cpu only)
+    - backend: 'torch', or 'onnx' / 'openvino' (needs sentence-transformers >= 3.2)
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    if backend == 'torch':
+        model = SentenceTransformer(model_name, device=device)
+    else:
+        model = SentenceTransformer(model_name, device=device, backend=backend)
+
+    if quantize:
+        if device != 'cpu' or backend != 'torch':
+            raise ValueError("int8 quantization is only supported for the torch backend on cpu")
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    model.eval()
+    return model
+
+
+# Model of a worker process, set by _init_worker
+_worker_model = None
+
+
+def _init_worker(model_kwargs):
+    global _worker_model
+    _worker_model = load_model(**model_kwargs)
+
+
+def _encode_batch(batch_texts):
+    return _worker_model.encode(batch_texts, batch_size=len(batch_texts), show_progress_bar=False)
+
+
+class TextEncoder():
+    """
+    Encodes lists of texts into a (len(texts), dim) float32 array.
+
+    Arguments:
+    - model_name: sentence-transformers model name
+    - device: 'cpu' or 'cuda'
+    - num_workers: number of encoding processes (1 = encode in this process)
+    - threads_per_worker: torch threads per process (None = torch default)
+    - batch_size: texts per length bucket
+    - quantize, backend: see load_model
+    """
+
+    def __init__(self, model_name=default_model_name, device='cpu', num_workers=1, threads_per_worker=None,
+                 batch_size=32, quantize=False, backend='torch'):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+        model_kwargs = {
+            'model_name': model_name,
+            'device': device,
+            'num_threads': threads_per_worker,
+            'quantize': quantize,
+            'backend': backend
+        }
+
+        self.model = None
+        self.pool = None
+        if num_workers == 1:
+            self.model = load_model(**model_kwargs)
+        else:
+            # spawn so workers don't inherit torch's thread pools from a fork
+            mp_context = multiprocessing.get_context('spawn')
+            self.pool = mp_context.Pool(num_workers, initializer=_init_worker, initargs=(model_kwargs,))
+
+    def encode(self, texts):
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        buckets = get_length_buckets(texts, self.batch_size)
+        bucket_texts = [[texts[i] for i in bucket] for bucket in buckets]
+
+        if self.pool is None:
+            bucket_embs = [self.model.encode(batch_texts, batch_size=len(batch_texts), show_progress_bar=False)
+                           for batch_texts in bucket_texts]
+        else:
+            bucket_embs = self.pool.map(_encode_batch, bucket_texts, chunksize=1)
+
+        embeddings = None
+        for bucket, embs in zip(buckets, bucket_embs):
+            if embeddings is None:
+                embeddings = np.zeros((len(texts), embs.shape[1]), dtype=np.float32)
+            embeddings[bucket] = embs
+
+        return embeddings
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
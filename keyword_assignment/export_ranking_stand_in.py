@@ -0,0 +1,84 @@
+"""
+Copies the tables the in-memory ranking engine reads (see
+ranking_engine.RankingEngine.from_db) from MySQL into a SQLite file, so
+ranking_service.py --sqlite can be load tested without a MySQL server.
+
+Usage:
+    python export_ranking_stand_in.py setup_data/ranking_stand_in.db
+"""
+import os
+import sqlite3
+import argparse
+import mysql.connector
+
+from rank_researchers import db_config
+from npmi_neighbours import top_npmi_table
+
+
+# (table, columns) copied, with the columns RankingEngine.from_db selects
+stand_in_tables = [
+    (top_npmi_table, ["parent_id INTEGER", "id INTEGER", "npmi REAL"]),
+    ("Publication_FoS", ["publication_id INTEGER", "FoS_id INTEGER"]),
+    ("Publication", ["id INTEGER PRIMARY KEY", "citation INTEGER"]),
+    ("Publication_Author", ["author_id INTEGER", "publication_mag_id INTEGER"]),
+    ("Author", ["id INTEGER PRIMARY KEY", "name TEXT"])
+]
+
+# Number of rows copied per round trip
+copy_chunk_size = 100000
+
+
+def copy_table(mysql_cur, sqlite_db, table_name, columns):
+    """
+    Arguments:
+    - columns: list of "name TYPE" column definitions of the SQLite table
+
+    Returns: number of copied rows.
+    """
+    col_names = [col.split(" ")[0] for col in columns]
+    sqlite_db.execute("CREATE TABLE " + table_name + " (" + ", ".join(columns) + ")")
+
+    insert_sql = "INSERT INTO " + table_name + " VALUES (" + ",".join(["?"] * len(columns)) + ")"
+    mysql_cur.execute("SELECT " + ", ".join(col_names) + " FROM " + table_name)
+
+    num_rows = 0
+    while True:
+        rows = mysql_cur.fetchmany(copy_chunk_size)
+        if len(rows) == 0:
+            break
+
+        sqlite_db.executemany(insert_sql, rows)
+        num_rows += len(rows)
+
+    sqlite_db.commit()
+    return num_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the ranking tables to a SQLite stand-in db")
+    parser.add_argument('out_file')
+    args = parser.parse_args()
+
+    # Written under a temporary name so an interrupted export leaves no
+    # half-filled stand-in behind
+    tmp_file = args.out_file + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    db = mysql.connector.connect(**db_config)
+    cur = db.cursor()
+    sqlite_db = sqlite3.connect(tmp_file)
+
+    for table_name, columns in stand_in_tables:
+        print("Copying " + table_name)
+        num_rows = copy_table(cur, sqlite_db, table_name, columns)
+        print("Copied " + str(num_rows) + " rows")
+
+    sqlite_db.execute("CREATE INDEX Publication_FoS_publication_id ON Publication_FoS (publication_id)")
+    sqlite_db.commit()
+    sqlite_db.close()
+    cur.close()
+    db.close()
+
+    os.replace(tmp_file, args.out_file)
+    print("Wrote " + args.out_file)
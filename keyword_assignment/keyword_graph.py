@@ -0,0 +1,188 @@
+"""
+Precomputed eps-neighbourhood graph over the keyword vocabulary, used to
+remove near-duplicate keywords without fitting DBSCAN on every call.
+
+With min_samples=2, DBSCAN makes every point that has at least one other
+point within eps a core point, so its clusters are exactly the connected
+components of the eps-graph restricted to the given points, and points
+with no neighbour get label -1. The graph only depends on the keyword
+embeddings, so it is built once and each dedup call reduces to a few
+neighbour lookups and a union-find over at most a few dozen items.
+
+Usage (offline build):
+    python keyword_graph.py setup_data/springer_keyword_embs.pickle setup_data/springer_keyword_graph.npz
+"""
+import sys
+import numpy as np
+import numpy.linalg as la
+import scipy.sparse as sp
+
+from utils import read_pickle_file
+
+
+dedup_eps = 0.47815
+
+
+def normalize_embs(emb_arr):
+    emb_norms = la.norm(emb_arr, axis=1)
+    return emb_arr / emb_norms[:,None]
+
+
+def build_keyword_graph(keyword_embs, eps=dedup_eps, chunk_size=512):
+    """
+    Finds, for every keyword, all other keywords within euclidean distance eps
+
+    Arguments:
+    - keyword_embs: (num_keywords, dim) array of normalized embeddings
+      (row = keyword id)
+    - eps: neighbourhood radius, same meaning as DBSCAN's eps
+    - chunk_size: number of keywords compared against the vocabulary at once
+
+    Returns: boolean scipy csr_matrix of shape (num_keywords, num_keywords);
+    row k lists the neighbours of keyword k (excluding k itself).
+
+    For unit vectors |a - b|^2 = 2 - 2 a.b, so the radius test is done on
+    dot products and each chunk is one matrix product.
+    """
+    keyword_embs = np.asarray(keyword_embs, dtype=np.float32)
+    num_keywords = len(keyword_embs)
+    min_sim = 1 - eps * eps / 2
+
+    row_chunks = []
+    col_chunks = []
+    for start in range(0, num_keywords, chunk_size):
+        sims = np.dot(keyword_embs[start:start + chunk_size], keyword_embs.T)
+        rows, cols = np.nonzero(sims >= min_sim)
+
+        rows += start
+        not_self = rows != cols
+        row_chunks.append(rows[not_self])
+        col_chunks.append(cols[not_self])
+
+    rows = np.concatenate(row_chunks)
+    cols = np.concatenate(col_chunks)
+    data = np.ones(len(rows), dtype=bool)
+
+    return sp.csr_matrix((data, (rows, cols)), shape=(num_keywords, num_keywords))
+
+
+def save_keyword_graph(graph, out_file, eps=dedup_eps):
+    np.savez(out_file, indptr=graph.indptr, indices=graph.indices,
+             shape=np.array(graph.shape), eps=np.array(eps))
+
+
+def load_keyword_graph(graph_file):
+    """
+    Returns: (csr_matrix, eps) as written by save_keyword_graph.
+    """
+    with np.load(graph_file) as f:
+        indices = f['indices']
+        data = np.ones(len(indices), dtype=bool)
+        graph = sp.csr_matrix((data, indices, f['indptr']), shape=tuple(f['shape']))
+        eps = float(f['eps'])
+
+    return graph, eps
+
+
+def group_labels(num_items, edges):
+    """
+    Labels the connected components of a small graph like DBSCAN(min_samples=2)
+
+    Arguments:
+    - num_items: number of items
+    - edges: iterable of (i, j) index pairs of neighbouring items
+
+    Returns: list of labels; -1 for items without neighbours, otherwise a
+    cluster index. Clusters are numbered in order of their first item, as
+    DBSCAN does.
+    """
+    parent = list(range(num_items))
+    has_neighbour = [False] * num_items
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in edges:
+        has_neighbour[i] = has_neighbour[j] = True
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    labels = []
+    root_to_label = {}
+    for i in range(num_items):
+        if not has_neighbour[i]:
+            labels.append(-1)
+            continue
+
+        root = find(i)
+        if root not in root_to_label:
+            root_to_label[root] = len(root_to_label)
+        labels.append(root_to_label[root])
+
+    return labels
+
+
+def get_dedup_labels(keyword_ids, graph):
+    """
+    Groups near-duplicate keywords using the precomputed keyword graph
+
+    Arguments:
+    - keyword_ids: list of keyword ids (repeats allowed)
+    - graph: csr_matrix from build_keyword_graph / load_keyword_graph
+
+    Returns: list of labels, same as
+    DBSCAN(eps, min_samples=2).fit(keyword_embs[keyword_ids]).labels_
+    up to renumbering of the clusters.
+    """
+    id_to_positions = {}
+    for i, kw_id in enumerate(keyword_ids):
+        id_to_positions.setdefault(kw_id, []).append(i)
+
+    indptr = graph.indptr
+    indices = graph.indices
+
+    edges = []
+    for kw_id, positions in id_to_positions.items():
+        # Repeats of one keyword are at distance 0 of each other
+        for i in positions[1:]:
+            edges.append((positions[0], i))
+
+        for neighbour_id in indices[indptr[kw_id]:indptr[kw_id + 1]].tolist():
+            if neighbour_id in id_to_positions:
+                edges.append((positions[0], id_to_positions[neighbour_id][0]))
+
+    return group_labels(len(keyword_ids), edges)
+
+
+def get_dedup_labels_from_embs(embs, eps=dedup_eps):
+    """
+    Same grouping as get_dedup_labels for keywords outside the vocabulary
+
+    Arguments:
+    - embs: (n, dim) array of normalized embeddings
+
+    Returns: list of DBSCAN(eps, min_samples=2)-style labels.
+    """
+    embs = np.asarray(embs, dtype=np.float32)
+    sims = np.dot(embs, embs.T)
+    rows, cols = np.nonzero(np.triu(sims >= 1 - eps * eps / 2, k=1))
+
+    return group_labels(len(embs), zip(rows.tolist(), cols.tolist()))
+
+
+if __name__ == '__main__':
+    keyword_embeddings_file = sys.argv[1]
+    graph_out_file = sys.argv[2]
+
+    print("Loading keyword embeddings")
+    keyword_embeddings = normalize_embs(read_pickle_file(keyword_embeddings_file))
+
+    print("Building keyword graph for " + str(len(keyword_embeddings)) + " keywords")
+    keyword_graph = build_keyword_graph(keyword_embeddings)
+    save_keyword_graph(keyword_graph, graph_out_file)
+
+    print("Done. Neighbour pairs: " + str(keyword_graph.nnz))
@@ -0,0 +1,110 @@
+"""
+Vectorized scoring of candidate keywords for a block of papers at once.
+
+A block is described by a sparse paper x keyword match matrix in CSR form:
+row i holds the candidate keyword ids of the i-th paper, in match order.
+Scoring a block is then one sampled dense product (paper embedding dotted
+with keyword embedding at every stored entry), followed by an elementwise
+division with a penalty vector indexed by keyword id.
+"""
+import math
+import numpy as np
+import numpy.linalg as la
+import scipy.sparse as sp
+
+from utils import standardize_non_ascii
+
+
+def build_penalty_divisors(word_to_id, word_to_other_freq, num_keywords, min_other_freq=1000):
+    """
+    Precomputes the general-word penalty for every keyword id
+
+    Arguments:
+    - word_to_id: keyword -> keyword id mapping
+    - word_to_other_freq: keyword -> frequency in non-cs arxiv papers
+    - num_keywords: size of the keyword id space
+    - min_other_freq: keywords at least this frequent outside cs are penalized
+
+    Returns: float64 array d of length num_keywords; a candidate score s for
+    keyword k becomes s / d[k]. d[k] = sqrt(other_freq) for penalized
+    keywords and 1 otherwise.
+    """
+    penalty_divisors = np.ones(num_keywords, dtype=np.float64)
+
+    for keyword, other_freq in word_to_other_freq.items():
+        if other_freq < min_other_freq:
+            continue
+
+        keyword_id = word_to_id.get(keyword)
+        if keyword_id is None:
+            keyword_id = word_to_id.get(standardize_non_ascii(keyword))
+        if keyword_id is None:
+            continue
+
+        penalty_divisors[keyword_id] = math.sqrt(other_freq)
+
+    return penalty_divisors
+
+
+def build_match_matrix(candidate_ids, num_keywords):
+    """
+    Builds the paper x keyword match matrix of a block
+
+    Arguments:
+    - candidate_ids: list with one list of candidate keyword ids per paper
+    - num_keywords: size of the keyword id space
+
+    Returns: scipy csr_matrix of shape (len(candidate_ids), num_keywords).
+    Entries keep the order (and any repeats) of candidate_ids, so row i
+    lines up one-to-one with candidate_ids[i].
+    """
+    row_lens = [len(ids) for ids in candidate_ids]
+
+    indptr = np.zeros(len(candidate_ids) + 1, dtype=np.int64)
+    np.cumsum(row_lens, out=indptr[1:])
+
+    indices = np.fromiter((kw_id for ids in candidate_ids for kw_id in ids),
+                          dtype=np.int64, count=indptr[-1])
+    data = np.ones(len(indices), dtype=np.float64)
+
+    return sp.csr_matrix((data, indices, indptr), shape=(len(candidate_ids), num_keywords))
+
+
+def score_block(match_matrix, paper_embs, keyword_embs, penalty_divisors):
+    """
+    Scores every candidate keyword of a block of papers
+
+    Arguments:
+    - match_matrix: paper x keyword csr_matrix from build_match_matrix or
+      trie.match_texts (only its structure is used)
+    - paper_embs: (num_papers, dim) array, row i is the embedding of paper i
+      (not necessarily normalized)
+    - keyword_embs: (num_keywords, dim) array of normalized keyword embeddings
+    - penalty_divisors: array from build_penalty_divisors
+
+    Returns: csr_matrix with the same structure as match_matrix whose data
+    holds cosine similarity / penalty for each candidate.
+    """
+    paper_embs = paper_embs / la.norm(paper_embs, axis=1)[:, None]
+
+    row_lens = np.diff(match_matrix.indptr)
+    rows = np.repeat(np.arange(match_matrix.shape[0]), row_lens)
+    cols = match_matrix.indices
+
+    sim_scores = np.einsum('ij,ij->i', keyword_embs[cols], paper_embs[rows])
+    scores = sim_scores.astype(np.float64) / penalty_divisors[cols]
+
+    return sp.csr_matrix((scores, cols.copy(), match_matrix.indptr.copy()), shape=match_matrix.shape)
+
+
+def get_row_scores(scored_matrix):
+    """
+    Splits a scored block back into one list of (keyword_id, score)
+    tuples per paper, in candidate order.
+    """
+    indptr = scored_matrix.indptr
+    keyword_ids = scored_matrix.indices.tolist()
+    scores = scored_matrix.data.tolist()
+
+    return [list(zip(keyword_ids[indptr[i]:indptr[i + 1]], scores[indptr[i]:indptr[i + 1]]))
+            for i in range(scored_matrix.shape[0])]
@@ -0,0 +1,139 @@
+"""
+Precomputed top NPMI neighbours of every keyword, used by
+rank_researchers.py instead of ranking FoS_npmi_Springer on every query.
+
+FoS_npmi_Springer stores each keyword pair once, in either id order. The
+FoS_Top_Npmi table holds, for every keyword (parent_id), its num_neighbours
+most similar other keywords by npmi in both id directions, plus the row
+(parent_id, parent_id, 1) for the keyword itself. A query's related
+keywords are then a primary key lookup on parent_id.
+
+The table is rebuilt under a temporary name and swapped in with RENAME
+TABLE, so running queries never see it missing or half-written.
+
+Usage (offline build, rerun after FoS_npmi_Springer changes):
+    python npmi_neighbours.py
+"""
+import mysql.connector
+import numpy as np
+
+from change_log import bump_data_version
+from utils import fetch_columns, drop_table, BulkInserter
+
+
+top_npmi_table = "FoS_Top_Npmi"
+num_neighbours = 10
+
+
+def get_group_ranks(group_ids):
+    """
+    Arguments:
+    - group_ids: sorted array
+
+    Returns: position of every element within its run of equal group_ids.
+    """
+    positions = np.arange(len(group_ids))
+    group_starts = np.ones(len(group_ids), dtype=bool)
+    group_starts[1:] = group_ids[1:] != group_ids[:-1]
+
+    return positions - np.maximum.accumulate(np.where(group_starts, positions, 0))
+
+
+def get_top_neighbours(id1s, id2s, npmis, keyword_ids, k=num_neighbours):
+    """
+    Selects the top k neighbours of every keyword
+
+    Arguments:
+    - id1s, id2s, npmis: FoS_npmi_Springer columns
+    - keyword_ids: ids of all keywords, each gets an identity row
+    - k: number of neighbours per keyword (ties broken by lower id)
+
+    Returns: (parent_ids, ids, npmis) arrays sorted by parent_id, then
+    npmi descending; a pair stored in both directions counts once, with its
+    highest npmi.
+    """
+    parent_ids = np.concatenate([id2s, id1s]).astype(np.int64)
+    ids = np.concatenate([id1s, id2s]).astype(np.int64)
+    npmis = np.concatenate([npmis, npmis]).astype(np.float64)
+
+    not_self = parent_ids != ids
+    parent_ids, ids, npmis = parent_ids[not_self], ids[not_self], npmis[not_self]
+
+    # Keep the highest npmi of every (parent_id, id) pair
+    order = np.lexsort((-npmis, ids, parent_ids))
+    parent_ids, ids, npmis = parent_ids[order], ids[order], npmis[order]
+    pair_keys = np.stack([parent_ids, ids], axis=1)
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = np.any(pair_keys[1:] != pair_keys[:-1], axis=1)
+    parent_ids, ids, npmis = parent_ids[first], ids[first], npmis[first]
+
+    order = np.lexsort((ids, -npmis, parent_ids))
+    parent_ids, ids, npmis = parent_ids[order], ids[order], npmis[order]
+    top = get_group_ranks(parent_ids) < k
+
+    keyword_ids = np.asarray(keyword_ids, dtype=np.int64)
+    parent_ids = np.concatenate([keyword_ids, parent_ids[top]])
+    ids = np.concatenate([keyword_ids, ids[top]])
+    npmis = np.concatenate([np.ones(len(keyword_ids)), npmis[top]])
+
+    order = np.lexsort((ids, -npmis, parent_ids))
+    return parent_ids[order], ids[order], npmis[order]
+
+
+def store_top_neighbours(db, parent_ids, ids, npmis, insert_batch_size=1000):
+    """
+    Replaces the FoS_Top_Npmi table with the given rows.
+    """
+    cur = db.cursor()
+    new_table = top_npmi_table + "_new"
+
+    drop_table(cur, new_table)
+    cur.execute("""
+        CREATE TABLE """ + new_table + """ (
+            parent_id INT,
+            id INT,
+            npmi DOUBLE,
+            PRIMARY KEY(parent_id, id)
+        )
+    """)
+
+    writer = BulkInserter(db, new_table, ["parent_id", "id", "npmi"], insert_batch_size, len(ids) + 1)
+    writer.add_many(zip(parent_ids.tolist(), ids.tolist(), npmis.tolist()))
+    writer.close()
+
+    cur.execute("CREATE TABLE IF NOT EXISTS " + top_npmi_table + " LIKE " + new_table)
+    cur.execute("RENAME TABLE " + top_npmi_table + " TO " + top_npmi_table + "_old, "
+                + new_table + " TO " + top_npmi_table)
+    drop_table(cur, top_npmi_table + "_old")
+
+    bump_data_version(cur, top_npmi_table)
+    db.commit()
+    cur.close()
+
+
+def build_top_npmi_table(db, k=num_neighbours):
+    """
+    Builds FoS_Top_Npmi from FoS_npmi_Springer and the FoS table.
+
+    Returns: number of rows stored.
+    """
+    cur = db.cursor()
+    id1s, id2s, npmis = fetch_columns(cur, "SELECT id1, id2, npmi FROM FoS_npmi_Springer",
+                                      [np.int64, np.int64, np.float64])
+    keyword_ids, = fetch_columns(cur, "SELECT id FROM FoS", [np.int64])
+    cur.close()
+
+    parent_ids, ids, npmis = get_top_neighbours(id1s, id2s, npmis, keyword_ids, k)
+    store_top_neighbours(db, parent_ids, ids, npmis)
+
+    return len(ids)
+
+
+if __name__ == '__main__':
+    from assign_researcher_kwds import db_config
+
+    mydb = mysql.connector.connect(**db_config)
+    num_rows = build_top_npmi_table(mydb)
+    mydb.close()
+
+    print("Stored " + str(num_rows) + " rows in " + top_npmi_table)
@@ -0,0 +1,134 @@
+"""
+Thread-safe LRU cache with a time-to-live and a data-version stamp, used
+to answer repeated ranking queries without touching the db.
+
+Every entry is dropped once it is older than ttl seconds. In addition, the
+cache compares a data version (e.g. the Data_Version rows written by the
+jobs that refresh the ranking tables, see change_log.py) at most every
+version_check_interval seconds and clears itself when it changed, so a
+refresh is picked up without waiting for the ttl. Data the cached values
+are computed from (e.g. an in-memory ranking engine) can be reloaded from
+on_version_change before the entries are dropped.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class QueryCache():
+    """
+    Arguments:
+    - max_size: maximum number of entries; the least recently used entry
+      is evicted first
+    - ttl: seconds an entry stays valid
+    - get_version: function returning the current data version (any value
+      comparable with ==), or None to only expire entries by ttl
+    - version_check_interval: minimum seconds between get_version calls
+    - on_version_change: optional function called when the data version
+      changes after the first check, before the entries are dropped
+
+    Values computed while the version changed are not cached: callers read
+    generation before computing a value and pass it to put.
+    """
+
+    def __init__(self, max_size=1024, ttl=600, get_version=None, version_check_interval=10,
+                 on_version_change=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_version = get_version
+        self.version_check_interval = version_check_interval
+        self.on_version_change = on_version_change
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.version = None
+        self.version_checked_at = None
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check_version(self, now):
+        if self.get_version is None:
+            return
+
+        with self.lock:
+            if self.version_checked_at is not None and now - self.version_checked_at < self.version_check_interval:
+                return
+
+            # Claimed before checking, so concurrent callers keep using the
+            # current entries instead of checking (and reloading) as well
+            first_check = self.version_checked_at is None
+            self.version_checked_at = now
+
+        # Called without the lock held, get_version may query the db
+        version = self.get_version()
+        if version == self.version:
+            return
+
+        if not first_check and self.on_version_change is not None:
+            self.on_version_change()
+
+        with self.lock:
+            self.version = version
+            self.generation += 1
+            self.entries.clear()
+
+    def get(self, key):
+        """
+        Returns: the cached value of key, or None if it is missing or expired.
+        """
+        now = time.monotonic()
+        self.check_version(now)
+
+        value = self.lookup(key, now)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key):
+        """
+        Same as get, but never calls get_version (so it does not block on
+        the db) and is not counted in hits / misses.
+        """
+        return self.lookup(key, time.monotonic())
+
+    def lookup(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or now - entry[0] >= self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, generation=None):
+        """
+        Caches value, unless generation (read before computing value) is
+        given and the version changed since.
+        """
+        now = time.monotonic()
+        self.check_version(now)
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self.entries[key] = (now, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
@@ -1,86 +1,98 @@
-from utils import gen_sql_in_tup, return_print_err, copy_temporary_table, drop_view, drop_table
+from utils import gen_sql_in_tup, return_print_err, drop_view
+from npmi_neighbours import top_npmi_table
+from ranking_engine import RankingEngine, num_top_authors
+from query_cache import QueryCache
+from change_log import get_data_version
+import argparse
+import threading
 import mysql.connector
+import mysql.connector.pooling
 
 
-def store_keywords(keyword_ids, cur, make_copy=True):
-    """
-    Stores top 10 similar keywords for each input keyword
+db_config = {
+    'host': "localhost",
+    'user': "root",
+    'password': "<replace with your db password>",
+    'database': "<replace with your db name>"
+}
 
-    Arguments:
-    - keyword_ids: list of ids of input keywords
-    - cur: db cursor
+# Set by load_ranking_engine(); rank_authors_keyword falls back to SQL
+# while it is None
+ranking_engine = None
 
-    Returns: None. each entry in Top_Keywords table is of the form (parent_id, keyword_id, npmi).
-    - parent_id: id of the original input keyword
-    - keyword_id: id of similar keyword
-    - npmi is a similarity score between the two keywords
-
-    Note: the identity row for each keyword_id is included by default with
-    similarity score 1 (i.e. for each kw_id in keywords_ids, there will be a
-    row in Top_Keywords of (kw_id, kw_id, 1))
-    """
-    fields_in_sql = gen_sql_in_tup(len(keyword_ids))
-
-    drop_table(cur, "Top_Keywords")
-    get_related_keywords_sql = """
-        CREATE TABLE Top_Keywords (
-            parent_id INT,
-            id INT,
-            npmi DOUBLE,
-            PRIMARY KEY(parent_id, id)
-        )
-
-        SELECT parent_id, id, npmi
-        FROM
-        (
-            SELECT parent_id, id, npmi,
-            @kw_rank := IF(@current_parent = parent_id, @kw_rank + 1, 1) AS kw_rank,
-            @current_parent := parent_id
-            FROM
-            (
-                (SELECT id2 AS parent_id,
-                id1 AS id, npmi
-                FROM FoS_npmi_Springer
-                WHERE id2 IN """ + fields_in_sql + """)
+# Set by init_ranking_pool(), used by rank_authors
+ranking_db_pool = None
+ranking_db_slots = None
 
-                UNION
+# Set by init_ranking_cache(); rank_authors does not cache while it is None
+ranking_cache = None
 
-                (SELECT
-                id1 AS parent_id,
-                id2 as id, npmi
-                FROM FoS_npmi_Springer
-                WHERE id1 IN """ + fields_in_sql + """)
-            ) as top_keywords
-            ORDER BY parent_id, npmi DESC
-        ) AS ranked_keywords
 
-        WHERE kw_rank <= 10
+def load_ranking_engine(cur):
     """
-    get_related_query_params = 2 * keyword_ids
-    cur.execute(get_related_keywords_sql, get_related_query_params)
-
-
-    append_given_sql = """
-        INSERT INTO Top_Keywords
-        (parent_id, id, npmi)
-        VALUES
-        """ + ",\n".join(["(%s, %s, 1)"] * len(keyword_ids))
-
-    append_given_query_params = [id for id in keyword_ids for i in range(2)]
-
-    cur.execute(append_given_sql, append_given_query_params)
+    Loads the in-memory ranking engine (see ranking_engine.py) used by
+    rank_authors_keyword for the rest of this process.
+    """
+    global ranking_engine
+    ranking_engine = RankingEngine.from_db(cur)
 
 
+def reload_ranking_engine():
+    """
+    Reloads the in-memory ranking engine, if one is loaded, on a connection
+    from the pool opened by init_ranking_pool. Called by the ranking cache
+    when a job bumps a Data_Version row; queries keep using the old engine
+    until the new one is loaded. If loading fails, the engine is dropped
+    and rank_authors falls back to SQL, so it never serves stale matrices.
+    """
+    global ranking_engine
+
+    if ranking_engine is None:
+        return
+
+    print("Data version changed, reloading the ranking engine")
+    try:
+        with ranking_db_slots:
+            db = ranking_db_pool.get_connection()
+            try:
+                cur = db.cursor()
+                try:
+                    engine = RankingEngine.from_db(cur)
+                finally:
+                    cur.close()
+            finally:
+                db.close()
+    except Exception as e:
+        print("Reloading the ranking engine failed, ranking with SQL: " + repr(e))
+        ranking_engine = None
+        return
+
+    ranking_engine = engine
+
+
+def get_related_keywords_sql(keyword_ids):
+    """
+    Returns: (sql, params) of a subquery selecting the rows of the input
+    keywords from FoS_Top_Npmi (built offline by npmi_neighbours.py).
+    """
+    sql = """(
+        SELECT parent_id, id, npmi
+        FROM """ + top_npmi_table + """
+        WHERE parent_id IN """ + gen_sql_in_tup(len(keyword_ids)) + """
+    )"""
+    return sql, list(keyword_ids)
 
 
-def compute_author_keyword_ranks(cur):
+def get_author_keyword_scores_sql(keyword_ids):
     """
-    Computes and stores score for each publication
+    Builds the query scoring each publication
 
     Arguments:
-    - cur: db cursor
+    - keyword_ids: list of ids of input keywords
 
-    Returns: None
+    Returns: (sql, params) of a query with one row (author_id, parent_id,
+    kw_id, max_npmi, citation, publication_id, comp_score) per author,
+    publication and input keyword.
 
 
     Each publication has an associated score for each input keyword.
@@ -91,18 +103,9 @@ def compute_author_keyword_ranks(cur):
     publication-keyword pair.
     """
 
-    drop_table(cur, "Author_Keyword_Scores")
-    create_author_ranks_sql = """
-        CREATE TEMPORARY TABLE Author_Keyword_Scores (
-            author_id BIGINT,
-            parent_id INT,
-            kw_id BIGINT,
-            citation INT,
-            publication_id BIGINT,
-            comp_score DECIMAL,
-            PRIMARY KEY(author_id, publication_id, parent_id)
-        )
+    related_sql, related_params = get_related_keywords_sql(keyword_ids)
 
+    author_keyword_scores_sql = """
         SELECT author_id,
         parent_id,
         MIN(FoS_id) AS kw_id,
@@ -117,7 +120,7 @@ def compute_author_keyword_ranks(cur):
             MAX(npmi) as max_npmi,
             IFNULL(citation, 0) AS citation
 
-            FROM Top_Keywords
+            FROM """ + related_sql + """ AS Top_Keywords
             JOIN Publication_FoS ON Top_Keywords.id = FoS_id
             JOIN Publication_Author ON publication_mag_id = publication_id
             JOIN Publication ON publication_id = Publication.id
@@ -130,7 +133,7 @@ def compute_author_keyword_ranks(cur):
             SELECT publication_id,
             parent_id, FoS_id, npmi
 
-            FROM Top_Keywords
+            FROM """ + related_sql + """ AS Top_Keywords
             JOIN Publication_FoS ON FoS_id = id
         ) AS Publication_Top_Keywords
 
@@ -139,11 +142,7 @@ def compute_author_keyword_ranks(cur):
 
         GROUP BY author_id, Publication_Scores.publication_id, parent_id
     """
-    cur.execute(create_author_ranks_sql)
-
-    # copy_temporary_table(cur, "Author_Keyword_Scores")
-
-
+    return author_keyword_scores_sql, 2 * related_params
 
 
 def rank_authors_keyword(keyword_ids, cur):
@@ -152,33 +151,35 @@ def rank_authors_keyword(keyword_ids, cur):
 
     Arguments:
     - keyword_ids: list of keyword ids by which we must rank
-    - cur: db cursor
+    - cur: db cursor, left open for the caller
 
     Returns: list of python dicts each representing an author.
     Each dict has keys 'name', 'id', and 'score' of author. During ranking
     each keyword is weighted separately and equally.
-    """
 
-    # Store top similar keywords
-    store_keywords(keyword_ids, cur)
+    Uses the in-memory engine if load_ranking_engine() was called, else
+    computes the ranking in the db with a single query (no scratch tables,
+    so concurrent queries on different connections do not interfere).
+    """
+    if ranking_engine is not None:
+        return ranking_engine.rank(keyword_ids)
 
     # Compute scores between each publication and input keyword
-    compute_author_keyword_ranks(cur, rank_type, entity_type)
-
+    author_keyword_scores_sql, query_params = get_author_keyword_scores_sql(keyword_ids)
 
     # Aggregate scores for each author
     get_author_ranks_sql = """
         SELECT Author.id, Author.name,
         SUM(comp_score) AS score
 
-        FROM Author_Keyword_Scores
+        FROM (""" + author_keyword_scores_sql + """) AS Author_Keyword_Scores
         JOIN Author ON id = author_id
 
         GROUP BY author_id
         ORDER BY score DESC
-        LIMIT 15
+        LIMIT """ + str(num_top_authors) + """
     """
-    cur.execute(get_author_ranks_sql)
+    cur.execute(get_author_ranks_sql, query_params)
     author_ranks = cur.fetchall()
 
     res = [{
@@ -187,33 +188,172 @@ def rank_authors_keyword(keyword_ids, cur):
         'score': t[2]
     } for t in author_ranks]
 
-    top_author_ids = [t["id"] for t in res]
+    return res
+
+
+def init_ranking_pool(config, pool_size=8):
+    """
+    Opens the connection pool used by rank_authors.
+
+    Arguments:
+    - config: mysql.connector connection arguments
+    - pool_size: maximum number of concurrent db queries (at most 32)
+    """
+    global ranking_db_pool, ranking_db_slots
+
+    ranking_db_pool = mysql.connector.pooling.MySQLConnectionPool(
+        pool_name="rank_researchers", pool_size=pool_size, **config)
+    ranking_db_slots = threading.BoundedSemaphore(pool_size)
 
-    author_id_to_idx = {}
-    for i in range(len(top_author_ids)):
-        author_id = top_author_ids[i]
-        author_id_to_idx[author_id] = i
 
-    cur.close()
+def get_ranking_data_version():
+    """
+    Returns: Data_Version rows of the tables ranking reads, or None if the
+    table does not exist yet (see change_log.py).
+    """
+    with ranking_db_slots:
+        db = ranking_db_pool.get_connection()
+        try:
+            cur = db.cursor()
+            try:
+                return get_data_version(cur)
+            except mysql.connector.errors.ProgrammingError:
+                return None
+            finally:
+                cur.close()
+        finally:
+            db.close()
+
+
+def init_ranking_cache(max_size=1024, ttl=600, version_check_interval=10):
+    """
+    Caches the results of rank_authors by keyword id set. Entries expire
+    after ttl seconds, and all of them are dropped when a job bumps a
+    Data_Version row (checked at most every version_check_interval seconds
+    on the pool opened by init_ranking_pool, if it was opened first). The
+    in-memory engine, if loaded, is reloaded first (reload_ranking_engine).
+
+    Without the pool (e.g. an engine loaded from a SQLite stand-in) entries
+    only expire by ttl and the engine is never reloaded.
+    """
+    global ranking_cache
+
+    if ranking_db_pool is not None:
+        ranking_cache = QueryCache(max_size, ttl, get_ranking_data_version, version_check_interval,
+                                   reload_ranking_engine)
+    else:
+        ranking_cache = QueryCache(max_size, ttl, None, version_check_interval)
+
+
+def get_ranking_key(keyword_ids):
+    """
+    Returns: cache key of a query; duplicate ids and their order do not
+    change the ranking.
+    """
+    return tuple(sorted(set(keyword_ids)))
+
+
+def rank_authors(keyword_ids):
+    """
+    Thread-safe version of rank_authors_keyword for serving queries.
+
+    Returns a cached result if init_ranking_cache was called (callers must
+    not modify it). Otherwise ranks in memory if the engine is loaded, else
+    on a connection borrowed from the pool opened by init_ranking_pool;
+    callers wait for a free connection instead of failing when all
+    pool_size are in use.
+    """
+    if ranking_cache is None:
+        return compute_author_ranks(keyword_ids)
+
+    key = get_ranking_key(keyword_ids)
+    res = ranking_cache.get(key)
+    if res is None:
+        generation = ranking_cache.generation
+        res = compute_author_ranks(key)
+        ranking_cache.put(key, res, generation)
+
+    return res
+
+
+def get_weighted_ranking_key(keyword_weights):
+    return tuple(sorted(keyword_weights.items()))
+
+
+def rank_authors_weighted(keyword_weights):
+    """
+    Ranks authors for keywords with user-given weights
+
+    Arguments:
+    - keyword_weights: dict of keyword id -> weight
+
+    Returns: list of python dicts as in rank_authors_keyword, each also
+    with a 'keyword_scores' dict of keyword id -> weighted score.
+
+    Needs the in-memory engine (load_ranking_engine), which scores all
+    keywords and their breakdowns in one pass; results are cached like
+    rank_authors.
+    """
+    if ranking_cache is None:
+        return compute_weighted_author_ranks(keyword_weights)
+
+    key = get_weighted_ranking_key(keyword_weights)
+    res = ranking_cache.get(key)
+    if res is None:
+        generation = ranking_cache.generation
+        res = compute_weighted_author_ranks(dict(key))
+        ranking_cache.put(key, res, generation)
+
     return res
 
 
+def compute_weighted_author_ranks(keyword_weights):
+    # Read once, reload_ranking_engine may replace or drop the engine
+    engine = ranking_engine
+    if engine is None:
+        raise ValueError("weighted ranking needs the in-memory engine, call load_ranking_engine first")
+
+    return engine.rank_weighted(keyword_weights)
+
+
+def compute_author_ranks(keyword_ids):
+    engine = ranking_engine
+    if engine is not None:
+        return engine.rank(keyword_ids)
+
+    with ranking_db_slots:
+        db = ranking_db_pool.get_connection()
+        try:
+            cur = db.cursor()
+            try:
+                return rank_authors_keyword(keyword_ids, cur)
+            finally:
+                cur.close()
+        finally:
+            # Returns the connection to the pool
+            db.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank authors for the test keywords")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="load the in-memory ranking engine instead of ranking in the db")
+    args = parser.parse_args()
 
     # Setting up db
-    db = mysql.connector.connect(
-      host="localhost",
-      user="root",
-      password="<replace with your db password>",
-      database="<replace with your db name>"
-    )
-    cur = db.cursor()
+    init_ranking_pool(db_config)
+    init_ranking_cache()
 
     # Ids of all keywords can be found in FoS table
     # Corresponds to keywords 'data mining' and 'security'
     test_kwd_ids = [4, 9]
 
-    top_authors = rank_authors_keyword(test_kwd_ids, cur)
+    if args.in_memory:
+        db = ranking_db_pool.get_connection()
+        cur = db.cursor()
+        load_ranking_engine(cur)
+        cur.close()
+        db.close()
+
+    top_authors = rank_authors(test_kwd_ids)
     print(top_authors)
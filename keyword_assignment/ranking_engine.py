@@ -0,0 +1,224 @@
+"""
+In-memory version of the expert ranking in rank_researchers.py.
+
+For every input keyword q, a publication p scores
+    max_npmi_qp * citation_p
+where max_npmi_qp is the highest npmi between q and any keyword of p among
+q's top neighbours (FoS_Top_Npmi, which includes q itself with npmi 1). An
+author's score is the sum over their publications and the input keywords.
+
+The engine keeps the neighbour table, the keyword -> publication and
+publication -> author incidence matrices and the citation counts as sparse
+arrays, so a query is a few gathers and group-bys over the matched
+publications instead of building temporary tables in MySQL.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+from author_scoring import get_id_index, build_author_pub_matrix
+from npmi_neighbours import top_npmi_table
+from utils import fetch_columns, get_top_k_indices
+
+
+num_top_authors = 15
+
+
+def expand_rows(matrix, rows):
+    """
+    Arguments:
+    - matrix: csr_matrix
+    - rows: array of row indices (may repeat)
+
+    Returns: (entries, pairs) where entries are the positions in
+    matrix.indices / matrix.data of the entries of every given row,
+    concatenated in order, and pairs[i] is the index into rows that
+    entries[i] came from.
+    """
+    row_lens = np.diff(matrix.indptr)[rows]
+    pairs = np.repeat(np.arange(len(rows)), row_lens)
+    row_offsets = np.repeat(matrix.indptr[rows] - np.cumsum(row_lens) + row_lens, row_lens)
+
+    return row_offsets + np.arange(len(pairs)), pairs
+
+
+class RankingEngine():
+    """
+    Arguments:
+    - keyword_ids: sorted unique ids of all keywords (matrix index space)
+    - neighbour_matrix: keywords x keywords csr_matrix, row q holds the npmi
+      of q's top neighbours
+    - keyword_pub_matrix: binary keywords x publications csr_matrix
+    - pub_author_matrix: binary publications x authors csr_matrix
+    - pub_citations: citation count of every publication
+    - author_ids, author_names: id and name of every author (matrix columns)
+    """
+
+    def __init__(self, keyword_ids, neighbour_matrix, keyword_pub_matrix, pub_author_matrix, pub_citations,
+                 author_ids, author_names):
+        self.keyword_ids = keyword_ids
+        self.neighbour_matrix = neighbour_matrix
+        self.keyword_pub_matrix = keyword_pub_matrix
+        self.pub_author_matrix = pub_author_matrix
+        self.pub_citations = pub_citations
+        self.author_ids = author_ids
+        self.author_names = author_names
+
+    @staticmethod
+    def from_db(cur):
+        """
+        Loads the engine from FoS_Top_Npmi, Publication_FoS, Publication,
+        Publication_Author and Author.
+        """
+        print("Loading " + top_npmi_table)
+        parent_ids, neighbour_ids, npmis = fetch_columns(cur, "SELECT parent_id, id, npmi FROM " + top_npmi_table,
+                                                         [np.int64, np.int64, np.float64])
+
+        print("Loading Publication_FoS")
+        pfs_pub_ids, pfs_fos_ids = fetch_columns(cur, "SELECT publication_id, FoS_id FROM Publication_FoS",
+                                                 [np.int64, np.int64])
+
+        print("Loading citation counts")
+        pub_ids, pub_citations = fetch_columns(cur, """
+            SELECT Publication.id, IFNULL(citation, 0)
+            FROM Publication
+            JOIN (SELECT DISTINCT publication_id FROM Publication_FoS) AS fos_pubs
+            ON fos_pubs.publication_id = Publication.id
+            ORDER BY Publication.id
+        """, [np.int64, np.float64])
+
+        print("Loading authors")
+        pa_author_ids, pa_pub_ids = fetch_columns(cur, "SELECT author_id, publication_mag_id FROM Publication_Author",
+                                                  [np.int64, np.int64])
+        author_ids, author_names = fetch_columns(cur, "SELECT id, name FROM Author ORDER BY id",
+                                                 [np.int64, object])
+
+        keyword_ids = np.unique(np.concatenate([parent_ids, neighbour_ids, pfs_fos_ids]))
+        num_keywords = len(keyword_ids)
+
+        neighbour_matrix = sp.csr_matrix((npmis, (get_id_index(keyword_ids, parent_ids)[0],
+                                                  get_id_index(keyword_ids, neighbour_ids)[0])),
+                                         shape=(num_keywords, num_keywords))
+
+        pub_idx, pub_found = get_id_index(pub_ids, pfs_pub_ids)
+        fos_idx = get_id_index(keyword_ids, pfs_fos_ids[pub_found])[0]
+        keyword_pub_matrix = sp.csr_matrix((np.ones(len(fos_idx)), (fos_idx, pub_idx[pub_found])),
+                                           shape=(num_keywords, len(pub_ids)))
+        keyword_pub_matrix.sum_duplicates()
+
+        pub_author_matrix = build_author_pub_matrix(pa_author_ids, pa_pub_ids, author_ids, pub_ids).T.tocsr()
+
+        return RankingEngine(keyword_ids, neighbour_matrix, keyword_pub_matrix, pub_author_matrix, pub_citations,
+                             author_ids, author_names)
+
+    def get_publication_scores(self, keyword_ids):
+        """
+        Arguments:
+        - keyword_ids: ids of the input keywords; unknown ids match nothing
+
+        Returns: (parent_idx, pub_idx, max_npmi) arrays with one entry per
+        matched (input keyword, publication) pair; parent_idx indexes the
+        input keywords after removing duplicates (np.unique order).
+        """
+        query_ids = np.unique(np.asarray(keyword_ids, dtype=np.int64))
+        keyword_idx, found = get_id_index(self.keyword_ids, query_ids)
+        parents = np.flatnonzero(found)
+
+        # Top neighbours of every input keyword
+        neighbour_entries, neighbour_pairs = expand_rows(self.neighbour_matrix, keyword_idx[parents])
+        related_idx = self.neighbour_matrix.indices[neighbour_entries]
+        related_npmis = self.neighbour_matrix.data[neighbour_entries]
+        related_parents = parents[neighbour_pairs]
+
+        # Publications of every neighbour
+        pub_entries, pub_pairs = expand_rows(self.keyword_pub_matrix, related_idx)
+        pub_idx = self.keyword_pub_matrix.indices[pub_entries]
+        npmis = related_npmis[pub_pairs]
+        parent_idx = related_parents[pub_pairs]
+
+        # Highest npmi of every (input keyword, publication) pair
+        pair_keys = parent_idx.astype(np.int64) * self.keyword_pub_matrix.shape[1] + pub_idx
+        order = np.lexsort((-npmis, pair_keys))
+        pair_keys = pair_keys[order]
+        first = np.ones(len(pair_keys), dtype=bool)
+        first[1:] = pair_keys[1:] != pair_keys[:-1]
+        order = order[first]
+
+        return parent_idx[order], pub_idx[order], npmis[order]
+
+    def score_author_keywords(self, keyword_ids, weights=None):
+        """
+        Arguments:
+        - keyword_ids: ids of the input keywords
+        - weights: weight of every id in np.unique(keyword_ids) order, or
+          None to weight all keywords equally (1)
+
+        Returns: (query_ids, author_idx, keyword_scores) where query_ids is
+        np.unique(keyword_ids) and keyword_scores[i, j] is the weighted score
+        of author author_idx[i] for keyword query_ids[j], for every author
+        with at least one matched publication.
+        """
+        query_ids = np.unique(np.asarray(keyword_ids, dtype=np.int64))
+        if weights is None:
+            weights = np.ones(len(query_ids))
+
+        parent_idx, pub_idx, max_npmis = self.get_publication_scores(query_ids)
+        pub_scores = max_npmis * self.pub_citations[pub_idx] * weights[parent_idx]
+
+        author_entries, author_pairs = expand_rows(self.pub_author_matrix, pub_idx)
+        author_idx, author_inverse = np.unique(self.pub_author_matrix.indices[author_entries], return_inverse=True)
+
+        # Group by (author, input keyword) in one bincount
+        keys = author_inverse * len(query_ids) + parent_idx[author_pairs]
+        keyword_scores = np.bincount(keys, weights=pub_scores[author_pairs], minlength=len(author_idx) * len(query_ids))
+
+        return query_ids, author_idx, keyword_scores.reshape(len(author_idx), len(query_ids))
+
+    def score_authors(self, keyword_ids):
+        """
+        Returns: (author_idx, scores) for every author with at least one
+        matched publication.
+        """
+        _, author_idx, keyword_scores = self.score_author_keywords(keyword_ids)
+        return author_idx, keyword_scores.sum(axis=1)
+
+    def rank(self, keyword_ids, k=num_top_authors):
+        """
+        Returns: list of at most k dicts with keys 'id', 'name' and 'score',
+        best first (same format as rank_researchers.rank_authors_keyword).
+        """
+        author_idx, scores = self.score_authors(keyword_ids)
+        top = get_top_k_indices(scores, k)
+
+        return [{
+            'id': int(self.author_ids[author_idx[i]]),
+            'name': self.author_names[author_idx[i]],
+            'score': float(scores[i])
+        } for i in top]
+
+    def rank_weighted(self, keyword_weights, k=num_top_authors):
+        """
+        Ranks authors by a weighted sum of their per-keyword scores, in the
+        same single pass as rank.
+
+        Arguments:
+        - keyword_weights: dict of keyword id -> weight
+
+        Returns: list of at most k dicts with keys 'id', 'name', 'score' and
+        'keyword_scores' (dict of keyword id -> weighted score, summing to
+        'score'), best first.
+        """
+        keyword_ids = sorted(keyword_weights)
+        weights = np.array([keyword_weights[keyword_id] for keyword_id in keyword_ids], dtype=np.float64)
+        if not np.all(np.isfinite(weights)):
+            raise ValueError("Keyword weights must be finite numbers, got " + str(keyword_weights))
+
+        query_ids, author_idx, keyword_scores = self.score_author_keywords(keyword_ids, weights)
+        scores = keyword_scores.sum(axis=1)
+        top = get_top_k_indices(scores, k)
+
+        return [{
+            'id': int(self.author_ids[author_idx[i]]),
+            'name': self.author_names[author_idx[i]],
+            'score': float(scores[i]),
+            'keyword_scores': dict(zip(query_ids.tolist(), keyword_scores[i].tolist()))
+        } for i in top]
@@ -0,0 +1,344 @@
+"""
+Local HTTP service for expert search around rank_researchers.rank_authors.
+
+Endpoints:
+    GET /rank?keywords=4,9  -> JSON list of {'id', 'name', 'score'}, best first
+    GET /rank?keywords=4,9&weights=2,0.5
+                            -> same, weighting each keyword's score and adding
+                               a 'keyword_scores' breakdown (needs the
+                               in-memory engine)
+    GET /metrics            -> JSON counters and per-stage latencies (ms)
+
+Cached results (see rank_researchers.init_ranking_cache) are answered
+directly on the event loop. Requests for the same keyword id set that
+arrive while it is being ranked wait for that computation instead of
+starting another one. Other queries go through a bounded queue served by
+--workers threads; when the queue is full the service answers 503 right
+away instead of letting latency grow.
+
+Usage:
+    python ranking_service.py --in-memory --workers 8
+    python ranking_service.py --sqlite setup_data/ranking_stand_in.db
+    curl 'localhost:8080/rank?keywords=4,9'
+
+--sqlite loads the in-memory ranking engine from a SQLite copy of the
+FoS_Top_Npmi, Publication_FoS, Publication, Publication_Author and Author
+tables, for load tests without a MySQL server. The copy is made with:
+    python export_ranking_stand_in.py setup_data/ranking_stand_in.db
+
+With MySQL, a Data_Version bump clears the cache and reloads the --in-memory
+engine (see rank_researchers.init_ranking_cache). A --sqlite engine is never
+reloaded and its cached results only expire by ttl.
+"""
+import json
+import math
+import time
+import sqlite3
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import rank_researchers
+from rank_researchers import get_ranking_key, get_weighted_ranking_key
+
+
+# Latencies kept per stage for the percentiles in /metrics
+metrics_window = 1000
+
+# Seconds a client gets to send its request line and headers
+request_timeout = 10
+
+# Longest accepted request line or header line
+max_line_size = 8192
+
+http_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 408: "Request Timeout",
+                500: "Internal Server Error", 501: "Not Implemented", 503: "Service Unavailable"}
+
+
+class StageMetrics():
+    """
+    Latencies of one request stage over the last metrics_window requests.
+    """
+
+    def __init__(self, window=metrics_window):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.latencies.append(seconds * 1000)
+        self.count += 1
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return {'count': self.count}
+
+        def percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+
+        return {
+            'count': self.count,
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': latencies[-1]
+        }
+
+
+class RankingService():
+    """
+    Arguments:
+    - rank: function mapping a list of keyword ids to a ranking; called
+      from worker threads, so it must be thread-safe
+    - rank_weighted: same for a dict of keyword id -> weight
+    - workers: number of rankings computed at once
+    - max_queue: number of distinct queries allowed to wait for a worker
+    """
+
+    def __init__(self, rank=rank_researchers.rank_authors, rank_weighted=rank_researchers.rank_authors_weighted,
+                 workers=4, max_queue=256):
+        self.rank = rank
+        self.rank_weighted = rank_weighted
+        self.num_workers = workers
+        self.max_queue = max_queue
+
+        self.executor = ThreadPoolExecutor(workers)
+        self.queue = None
+        self.worker_tasks = []
+        self.in_flight = {}
+
+        self.stages = {'queue': StageMetrics(), 'rank': StageMetrics(), 'request': StageMetrics()}
+        self.counters = {'requests': 0, 'cache_hits': 0, 'coalesced': 0, 'rejected': 0, 'errors': 0}
+
+    async def start(self, host, port):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.worker_tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.num_workers)]
+        self.worker_tasks.append(asyncio.ensure_future(self.version_checker()))
+
+        return await asyncio.start_server(self.handle_connection, host, port, limit=max_line_size)
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            key, rank, rank_arg, future, enqueued_at = await self.queue.get()
+            started_at = time.perf_counter()
+            self.stages['queue'].add(started_at - enqueued_at)
+
+            try:
+                res = await loop.run_in_executor(self.executor, rank, rank_arg)
+                future.set_result(res)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.stages['rank'].add(time.perf_counter() - started_at)
+                del self.in_flight[key]
+                self.queue.task_done()
+
+    async def version_checker(self):
+        """
+        Checks the ranking cache's data version off the event loop, so
+        cache hits (which never check it) still see refreshes; a change
+        also reloads the in-memory engine.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            ranking_cache = rank_researchers.ranking_cache
+            if ranking_cache is None:
+                return
+
+            try:
+                await loop.run_in_executor(None, ranking_cache.check_version, time.monotonic())
+            except Exception as e:
+                print("Data version check failed: " + repr(e))
+            await asyncio.sleep(ranking_cache.version_check_interval)
+
+    async def get_ranking(self, keyword_ids, weights=None):
+        """
+        Returns: the ranking of keyword_ids (weighted by weights, a list
+        aligned with keyword_ids, if given), from the ranking cache if
+        possible, else shared with identical queries that are still running.
+
+        Raises asyncio.QueueFull if the query would have to wait behind
+        max_queue others.
+        """
+        if weights is None:
+            key = get_ranking_key(keyword_ids)
+            rank, rank_arg = self.rank, list(key)
+        else:
+            key = get_weighted_ranking_key(dict(zip(keyword_ids, weights)))
+            rank, rank_arg = self.rank_weighted, dict(key)
+
+        # Cache hits skip the queue; peek leaves the data version check to
+        # version_checker and the workers, so it never waits on the db
+        ranking_cache = rank_researchers.ranking_cache
+        if ranking_cache is not None:
+            res = ranking_cache.peek(key)
+            if res is not None:
+                self.counters['cache_hits'] += 1
+                return res
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters['coalesced'] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((key, rank, rank_arg, future, time.perf_counter()))
+            self.in_flight[key] = future
+
+        # Shielded so one client disconnecting does not cancel the others
+        return await asyncio.shield(future)
+
+    def get_metrics(self):
+        res = dict(self.counters)
+        res['in_flight'] = len(self.in_flight)
+        res['queued'] = self.queue.qsize()
+        res['stages'] = {name: stage.summary() for name, stage in self.stages.items()}
+
+        ranking_cache = rank_researchers.ranking_cache
+        if ranking_cache is not None:
+            res['cache'] = {'size': len(ranking_cache), 'hits': ranking_cache.hits, 'misses': ranking_cache.misses}
+
+        return res
+
+    async def handle_request(self, target):
+        """
+        Returns: (status, body) of a GET request for target.
+        """
+        url = urlsplit(target)
+
+        if url.path == '/metrics':
+            return 200, self.get_metrics()
+
+        if url.path != '/rank':
+            return 404, {'error': "unknown path " + url.path}
+
+        query = parse_qs(url.query)
+        try:
+            keyword_ids = [int(s) for s in ",".join(query.get('keywords', [])).split(",") if s != ""]
+        except ValueError:
+            return 400, {'error': "keywords must be a comma-separated list of ids"}
+
+        if len(keyword_ids) == 0:
+            return 400, {'error': "no keywords given"}
+
+        weights = None
+        if 'weights' in query:
+            if rank_researchers.ranking_engine is None:
+                return 501, {'error': "weighted ranking needs the in-memory engine (--in-memory or --sqlite)"}
+
+            try:
+                weights = [float(s) for s in ",".join(query['weights']).split(",")]
+            except ValueError:
+                return 400, {'error': "weights must be a comma-separated list of numbers"}
+
+            if not all(math.isfinite(weight) for weight in weights):
+                return 400, {'error': "weights must be finite numbers"}
+
+            if len(weights) != len(keyword_ids) or len(set(keyword_ids)) != len(keyword_ids):
+                return 400, {'error': "give one weight per distinct keyword id"}
+
+        self.counters['requests'] += 1
+        try:
+            return 200, await self.get_ranking(keyword_ids, weights)
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return 503, {'error': "too many queued queries"}
+        except Exception as e:
+            self.counters['errors'] += 1
+            return 500, {'error': repr(e)}
+
+    async def read_request_line(self, reader):
+        """
+        Returns: the request line split into words; the headers are read
+        and skipped, requests have no body.
+        """
+        request_line = (await reader.readline()).decode('latin-1').split()
+
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        return request_line
+
+    async def handle_connection(self, reader, writer):
+        started_at = time.perf_counter()
+
+        try:
+            try:
+                request_line = await asyncio.wait_for(self.read_request_line(reader), request_timeout)
+            except asyncio.TimeoutError:
+                request_line = None
+                status, body = 408, {'error': "request not received within " + str(request_timeout) + "s"}
+            except (ValueError, asyncio.LimitOverrunError, asyncio.IncompleteReadError):
+                # readline raises ValueError for lines longer than max_line_size
+                request_line = None
+                status, body = 400, {'error': "malformed or too long request"}
+
+            if request_line is None:
+                pass
+            elif len(request_line) < 2 or request_line[0] != 'GET':
+                status, body = 400, {'error': "only GET requests are supported"}
+            else:
+                status, body = await self.handle_request(request_line[1])
+
+            payload = json.dumps(body, default=str).encode('utf-8')
+            writer.write(("HTTP/1.1 " + str(status) + " " + http_reasons[status] + "\r\n"
+                          + "Content-Type: application/json\r\n"
+                          + "Content-Length: " + str(len(payload)) + "\r\n"
+                          + ("Retry-After: 1\r\n" if status == 503 else "")
+                          + "Connection: close\r\n\r\n").encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.stages['request'].add(time.perf_counter() - started_at)
+
+
+def load_sqlite_engine(db_file):
+    db = sqlite3.connect(db_file)
+    cur = db.cursor()
+    rank_researchers.load_ranking_engine(cur)
+    cur.close()
+    db.close()
+
+
+async def serve(host, port, workers, max_queue):
+    service = RankingService(workers=workers, max_queue=max_queue)
+    server = await service.start(host, port)
+    print("Serving expert search on http://" + host + ":" + str(port))
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HTTP service for expert search")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=4, help="rankings computed at once (db connections)")
+    parser.add_argument('--max-queue', type=int, default=256, help="distinct queries allowed to wait")
+    parser.add_argument('--in-memory', action='store_true', help="rank with the in-memory engine")
+    parser.add_argument('--sqlite', help="load the in-memory engine from this SQLite stand-in db")
+    args = parser.parse_args()
+
+    if args.sqlite is not None:
+        load_sqlite_engine(args.sqlite)
+        print("Ranking engine loaded from " + args.sqlite + "; it is not reloaded when the data changes")
+    else:
+        rank_researchers.init_ranking_pool(rank_researchers.db_config, args.workers)
+
+        if args.in_memory:
+            db = rank_researchers.ranking_db_pool.get_connection()
+            cur = db.cursor()
+            rank_researchers.load_ranking_engine(cur)
+            cur.close()
+            db.close()
+
+    rank_researchers.init_ranking_cache()
+
+    asyncio.run(serve(args.host, args.port, args.workers, args.max_queue))
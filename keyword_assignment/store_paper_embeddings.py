@@ -6,53 +6,176 @@ Generating Sentence-BERT embeddings (paper abstracts + title):
     Size 58883, est time: 15381s (~4 hrs)
     Size: 445715, time: 124014.893s (~34.4 hrs)
 
+Usage:
+    python store_paper_embeddings.py            # only new or changed papers
+    python store_paper_embeddings.py --full     # re-encode every paper
+    python store_paper_embeddings.py --device cpu --workers 4 --threads-per-worker 4 --quantize
+
+Embeddings are kept in an embedding store (see embedding_store.py) together
+with a hash of the title + abstract each one was encoded from. A normal run
+streams the Publication table, encodes only papers that are missing from the
+store or whose text hash changed, and writes them to the store every
+--checkpoint-size papers, so an interrupted run resumes where it stopped.
+
+Rows converted from the old pickles carry no text hash; the first run
+records the current hash for them without re-encoding.
+
+Encoding goes through encoding_engine.TextEncoder, which defaults to the cpu
+when no GPU is available. Note that --quantize and the onnx backend give
+slightly different embeddings than the original model, so a store should
+not mix rows from different settings (use --full when switching).
 """
 
 import sys
 import torch
-import pickle
+import argparse
+import numpy as np
 import mysql.connector
-from sentence_transformers import SentenceTransformer
 
 sys.path.insert(1, '../utils')
-from utils import read_pickle_file, write_pickle_data, concat_paper_info
-
-
-db = mysql.connector.connect(
-  host="localhost",
-  user="<user>",
-  password="<db password>",
-  database="<db>"
-)
-cursor = db.cursor()
-
-
-emb_out_file = "SB_paper_embeddings.pickle"
-idx_out_file = "SB_paper_embedding_mag_ids.pickle"
-
-
-cursor.execute("""
-    SELECT id, title, abstract
-    FROM Publication
-    WHERE abstract IS NOT NULL
-""")
-paper_ts = cursor.fetchall()
-
-
-print("Loading and preprocessing data/models")
-model = SentenceTransformer('bert-base-nli-mean-tokens')
-# model = SentenceTransformer('bert-base-nli-mean-tokens')
-# model = BertForMaskedLM.from_pretrained('sentence-transformers/paraphrase-MiniLM-L6-v2')
-
-mag_ids = [t[0] for t in paper_ts]
-paper_raw = [concat_paper_info(t[1], t[2]) for t in paper_ts]
-
-
-print("Getting embeddings for " + str(len(paper_raw)) + " papers")
-# paper_embeddings = run_model(paper_raw)
-paper_embeddings = model.encode(paper_raw, show_progress_bar=True, device='cuda')
-
-
-print("Done. Saving data")
-write_pickle_data(paper_embeddings, emb_out_file)
-write_pickle_data(mag_ids, idx_out_file)
+from utils import concat_paper_info, stream_papers, get_chunks
+from encoding_engine import TextEncoder
+from embedding_cache import EmbeddingCache, CachedEncoder
+from embedding_store import EmbeddingStore, update_embedding_store, update_text_hashes, hash_text, text_hash_dtype
+
+
+model_name = 'bert-base-nli-mean-tokens'
+store_dir = "setup_data/SB_paper_embeddings"
+
+# Number of papers compared against the store at a time
+compare_chunk_size = 10000
+
+
+def find_stale_papers(store, paper_ids, text_hashes):
+    """
+    Compares a chunk of papers against the store
+
+    Arguments:
+    - store: EmbeddingStore, or None if every paper should be encoded
+    - paper_ids: list of paper ids
+    - text_hashes: S16 array, hash of each paper's text
+
+    Returns: (stale, unhashed) boolean masks over paper_ids. Stale papers
+    are missing from the store or have a different text hash and need to be
+    encoded; unhashed papers are in the store without a hash (converted
+    from pickles) and only need their hash recorded.
+    """
+    if store is None:
+        return np.ones(len(paper_ids), dtype=bool), np.zeros(len(paper_ids), dtype=bool)
+
+    rows, found = store.find_rows(paper_ids)
+    stored_hashes = np.asarray(store.text_hashes)[rows]
+
+    unhashed = found & (stored_hashes == b'')
+    stale = ~found | (~unhashed & (stored_hashes != text_hashes))
+
+    return stale, unhashed
+
+
+def write_to_store(encoder, store, paper_ids, paper_texts, text_hashes, rehash_ids, rehash_hashes):
+    """
+    Encodes paper_texts and writes them, plus the recorded hashes of
+    rehash_ids, to the store.
+
+    Returns: the reopened EmbeddingStore.
+    """
+    if len(paper_texts) > 0:
+        # paper_embeddings = run_model(paper_raw)
+        update_embedding_store(store_dir, paper_ids, encoder.encode(paper_texts), text_hashes, model_name)
+    if len(rehash_ids) > 0:
+        # Only the hashes change, the embeddings are not rewritten
+        update_text_hashes(store_dir, rehash_ids, rehash_hashes)
+
+    return EmbeddingStore(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Store Sentence-BERT embeddings of papers")
+    parser.add_argument('--full', action='store_true',
+                        help="re-encode every paper instead of only new or changed ones")
+    parser.add_argument('--checkpoint-size', type=int, default=20000,
+                        help="number of papers encoded between writes to the store")
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default=None,
+                        help="default: cuda if available, else cpu")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of encoding processes")
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help="torch threads per encoding process")
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help="texts per length-bucketed batch")
+    parser.add_argument('--quantize', action='store_true',
+                        help="int8 dynamic quantization (cpu only)")
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch')
+    parser.add_argument('--cache-file', default=None,
+                        help="optional embedding cache (see embedding_cache.py) consulted before encoding")
+    args = parser.parse_args()
+
+    db = mysql.connector.connect(
+      host="localhost",
+      user="<user>",
+      password="<db password>",
+      database="<db>"
+    )
+
+
+    device = args.device
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    print("Loading and preprocessing data/models (device: " + device + ")")
+    encoder = TextEncoder(model_name, device, args.workers, args.threads_per_worker, args.batch_size,
+                          args.quantize, args.backend)
+
+    if args.cache_file is not None:
+        # Quantized / onnx embeddings differ slightly, so they get their own cache key
+        cache_model_name = model_name + ('-int8' if args.quantize else '') \
+            + ('-' + args.backend if args.backend != 'torch' else '')
+        text_encoder = encoder
+        encoder = CachedEncoder(EmbeddingCache(args.cache_file, cache_model_name), lambda: text_encoder)
+    # model = SentenceTransformer('bert-base-nli-mean-tokens')
+    # model = BertForMaskedLM.from_pretrained('sentence-transformers/paraphrase-MiniLM-L6-v2')
+
+    store = None
+    try:
+        store = EmbeddingStore(store_dir)
+    except FileNotFoundError:
+        print("No embedding store at " + store_dir + ", encoding every paper")
+
+    pending_ids, pending_texts, pending_hashes = [], [], []
+    rehash_ids, rehash_hashes = [], []
+    num_encoded = 0
+
+    print("Getting embeddings for new and changed papers")
+    for paper_chunk in get_chunks(stream_papers(db), compare_chunk_size):
+        paper_ids = [t[0] for t in paper_chunk]
+        paper_texts = [concat_paper_info(t[1], t[2]) for t in paper_chunk]
+        text_hashes = np.array([hash_text(text) for text in paper_texts], dtype=text_hash_dtype)
+
+        stale, unhashed = find_stale_papers(None if args.full else store, paper_ids, text_hashes)
+
+        for i in np.nonzero(stale)[0]:
+            pending_ids.append(paper_ids[i])
+            pending_texts.append(paper_texts[i])
+            pending_hashes.append(text_hashes[i])
+        for i in np.nonzero(unhashed)[0]:
+            rehash_ids.append(paper_ids[i])
+            rehash_hashes.append(text_hashes[i])
+
+        if len(pending_ids) + len(rehash_ids) >= args.checkpoint_size:
+            store = write_to_store(encoder, store, pending_ids, pending_texts, pending_hashes, rehash_ids, rehash_hashes)
+            num_encoded += len(pending_ids)
+            print("Encoded " + str(num_encoded) + " papers")
+
+            pending_ids, pending_texts, pending_hashes = [], [], []
+            rehash_ids, rehash_hashes = [], []
+
+    if len(pending_ids) + len(rehash_ids) > 0:
+        store = write_to_store(encoder, store, pending_ids, pending_texts, pending_hashes, rehash_ids, rehash_hashes)
+        num_encoded += len(pending_ids)
+
+
+    if args.cache_file is not None:
+        encoder.cache.close()
+        encoder = text_encoder
+    encoder.close()
+    print("Done. Encoded " + str(num_encoded) + " new or changed papers")
@@ -0,0 +1,213 @@
+import unicodedata
+
+
+def _is_word_char(char):
+    # Same definition as \w for str patterns in re
+    return char.isalnum() or char == '_'
+
+
+def fold_case(text):
+    """
+    Lowercases text without changing its length, so offsets into the
+    folded text are offsets into the original text. Characters whose
+    lowercase form is longer than one character are left unchanged.
+    """
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+
+    return ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+def normalize_text(text):
+    """
+    Puts text in the form the automaton matches against: NFC normalized,
+    then case folded with fold_case. Match offsets are offsets into this
+    form, which equal offsets into text whenever text is already NFC (the
+    usual case).
+    """
+    return fold_case(unicodedata.normalize('NFC', text))
+
+
+class AhoCorasick():
+    """Aho-Corasick automaton over a set of keywords. Finds all keyword occurrences
+    in one left-to-right pass over a text, instead of restarting a trie walk at
+    every word boundary.
+
+    Matching is case-insensitive and keywords and texts are NFC normalized
+    first (see normalize_text). With word_boundary=True a match must start and
+    end at a word boundary, with the same meaning as \\b in re, so the non-overlapping
+    mode returns the same matches as construct_re's pattern."""
+
+    def __init__(self, keywords, word_boundary=True):
+        self.word_boundary = word_boundary
+        self.keywords = []
+        self.keyword_to_idx = {}
+
+        # Optional external id of each keyword (e.g. FoS id), see set_keyword_ids
+        self.keyword_ids = None
+
+        # Node 0 is the root. goto[n] maps a character to the next node,
+        # fail[n] is the node of the longest proper suffix that is also in
+        # the trie, out[n] lists the keywords ending at n (directly or via fail).
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        for keyword in keywords:
+            self._add(keyword)
+
+        self._build_fail_links()
+
+    @staticmethod
+    def from_trie(trie, word_boundary=True):
+        """
+        Builds an automaton from the keywords stored in a Trie.
+        """
+        return AhoCorasick(trie.keywords(), word_boundary)
+
+    def _add(self, keyword):
+        keyword = normalize_text(keyword)
+        if len(keyword) == 0 or keyword in self.keyword_to_idx:
+            return
+
+        node = 0
+        for char in keyword:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            node = next_node
+
+        keyword_idx = len(self.keywords)
+        self.keywords.append(keyword)
+        self.keyword_to_idx[keyword] = keyword_idx
+        self.out[node] = (keyword_idx,)
+
+    def _build_fail_links(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail_node = self.fail[node]
+                while fail_node and char not in self.goto[fail_node]:
+                    fail_node = self.fail[fail_node]
+
+                self.fail[child] = self.goto[fail_node].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+                queue.append(child)
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def set_keyword_ids(self, get_id):
+        """
+        Stores an external id for every keyword, as returned by get_id(keyword)
+        for the normalized keyword (None if it has no id). find_ids and
+        count_ids report these ids.
+        """
+        self.keyword_ids = [get_id(keyword) for keyword in self.keywords]
+
+    def _is_boundary(self, text, idx):
+        before = idx > 0 and _is_word_char(text[idx - 1])
+        after = idx < len(text) and _is_word_char(text[idx])
+        return before != after
+
+    def iter_all(self, text):
+        """
+        Yields (keyword_idx, start, end) for every occurrence of every keyword,
+        including overlapping ones, ordered by end offset.
+
+        Offsets are into normalize_text(text), which is computed once here.
+        """
+        folded = normalize_text(text)
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        keywords = self.keywords
+        check_boundary = self.word_boundary
+
+        node = 0
+        for idx, char in enumerate(folded):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            if out[node]:
+                end = idx + 1
+                for keyword_idx in out[node]:
+                    start = end - len(keywords[keyword_idx])
+                    if check_boundary and not (self._is_boundary(folded, start) and self._is_boundary(folded, end)):
+                        continue
+                    yield (keyword_idx, start, end)
+
+    def finditer(self, text, overlapping=False):
+        """
+        Yields (keyword_idx, start, end) ordered by start offset.
+
+        With overlapping=False, matches are picked like re.finditer over
+        construct_re's pattern: the leftmost match wins, the longest
+        keyword at that position is taken, and the scan resumes at its end.
+        """
+        matches = sorted(self.iter_all(text), key=lambda t: (t[1], -t[2]))
+        if overlapping:
+            for match in matches:
+                yield match
+            return
+
+        last_end = 0
+        for match in matches:
+            if match[1] >= last_end:
+                yield match
+                last_end = match[2]
+
+    def find_ids(self, text, overlapping=False):
+        """
+        Yields (keyword_id, start, end) ordered by start offset, with the ids
+        from set_keyword_ids. Matches of keywords without an id are skipped.
+        Offsets are into normalize_text(text).
+        """
+        if self.keyword_ids is None:
+            raise ValueError("Keyword ids are not set, call set_keyword_ids first")
+
+        keyword_ids = self.keyword_ids
+        for keyword_idx, start, end in self.finditer(text, overlapping):
+            keyword_id = keyword_ids[keyword_idx]
+            if keyword_id is not None:
+                yield (keyword_id, start, end)
+
+    def count_ids(self, text, overlapping=False):
+        """
+        Returns: dict of keyword_id -> number of matches in text, in order
+        of first match.
+        """
+        counts = {}
+        for keyword_id, _, _ in self.find_ids(text, overlapping):
+            counts[keyword_id] = counts.get(keyword_id, 0) + 1
+
+        return counts
+
+    def count_matches(self, text, overlapping=False):
+        """
+        Returns: dict of keyword_idx -> number of matches in text.
+        """
+        counts = {}
+        for keyword_idx, _, _ in self.finditer(text, overlapping):
+            counts[keyword_idx] = counts.get(keyword_idx, 0) + 1
+
+        return counts
+
+    def get_matches(self, inp_text, include_counts=False, overlapping=False):
+        """
+        Same output format as trie.get_matches: a list of lowercased keywords,
+        or with include_counts a list of (keyword, count) sorted by count.
+        """
+        counts = self.count_matches(inp_text, overlapping)
+
+        if include_counts:
+            keyword_freq_ts = [(self.keywords[keyword_idx], count) for keyword_idx, count in counts.items()]
+            return sorted(keyword_freq_ts, key=lambda t: t[1], reverse=True)
+
+        return [self.keywords[keyword_idx] for keyword_idx in counts]
@@ -1,24 +1,270 @@
 # https://stackoverflow.com/questions/42742810/speed-up-millions-of-regex-replacements-in-python-3/42789508#42789508
 
 import re
+from array import array
+
+
+def _next_free_slot(check, start):
+    # list.index skips taken slots in C
+    try:
+        return check.index(-1, start)
+    except ValueError:
+        return max(start, len(check))
 
 
 class Trie():
     """Regex::Trie in Python. Creates a Trie out of a list of words. The trie can be exported to a Regex pattern.
-    The corresponding Regex should match much faster than a simple Regex union."""
+    The corresponding Regex should match much faster than a simple Regex union.
+
+    Nodes are integer ids into flat arrays rather than nested dicts. Node 0 is
+    the root; node n was reached from parent[n] by the character char[n], and
+    keyword_id[n] is the id of the word ending at n (-1 if none). Words get ids
+    in the order they are first added, and nodes in the order they are created.
+
+    compact() freezes the trie: children are laid out as one edge table sorted
+    by (parent, char), and the (node, char) -> child dict used while adding
+    words is dropped (it is rebuilt if more words are added). Lookups go
+    through a double array, where the child of state s by character code c is
+    base[s] + c if check[base[s] + c] == s. A compacted trie holds no per-node
+    Python objects, so forked workers can share it without copying pages."""
 
     def __init__(self):
-        self.data = {}
+        self._parent = array('i', [-1])
+        self._char = array('i', [0])
+        self._keyword_id = array('i', [-1])
+
+        # keyword id -> node where the keyword ends
+        self._keyword_nodes = array('i')
+
+        # keyword id -> number of nodes when the keyword was added, which
+        # places its end marker among the children of its node in dump()
+        self._keyword_num_nodes = array('i')
+
+        # (node, char) -> child while words are being added
+        self._edges = {}
+
+        # Edge table from compact()
+        self._edge_start = None
+        self._edge_nodes = None
+
+        # Double array from _get_double_array()
+        self._codes = None
+        self._base = None
+        self._check = None
+        self._state_keyword_id = None
+
+    def __len__(self):
+        return len(self._keyword_nodes)
+
+    def _get_edges(self):
+        if self._edges is None:
+            self._edges = {(self._parent[node], chr(self._char[node])): node
+                           for node in range(1, len(self._parent))}
+        return self._edges
 
     def add(self, word):
-        ref = self.data
+        edges = self._get_edges()
+        node = 0
         for char in word:
-            ref[char] = char in ref and ref[char] or {}
-            ref = ref[char]
-        ref[''] = 1
+            child = edges.get((node, char))
+            if child is None:
+                child = len(self._parent)
+                self._parent.append(node)
+                self._char.append(ord(char))
+                self._keyword_id.append(-1)
+                edges[(node, char)] = child
+                self._edge_start = None
+                self._base = None
+            node = child
+
+        if self._keyword_id[node] < 0:
+            self._keyword_id[node] = len(self._keyword_nodes)
+            self._keyword_nodes.append(node)
+            self._keyword_num_nodes.append(len(self._parent))
+            # The double array copies keyword ids, so it is stale even if
+            # no node was created (word is a prefix of an added word)
+            self._base = None
+
+    def compact(self):
+        """
+        Lays the children of every node out in one edge table sorted by
+        (parent, char). Call it once all words are added (construct_trie
+        does); adding a word afterwards drops the table until compact() is
+        called again.
+
+        Returns: self
+        """
+        if self._edge_start is not None:
+            return self
+
+        num_nodes = len(self._parent)
+        parent = self._parent
+        char = self._char
+
+        # Children of node n are edge_nodes[edge_start[n]:edge_start[n + 1]]
+        sorted_nodes = sorted(range(1, num_nodes), key=lambda n: (parent[n], char[n]))
+        edge_start = array('i', [0]) * (num_nodes + 1)
+        for node in sorted_nodes:
+            edge_start[parent[node] + 1] += 1
+        for node in range(num_nodes):
+            edge_start[node + 1] += edge_start[node]
+
+        self._edge_nodes = array('i', sorted_nodes)
+        self._edge_start = edge_start
+        self._edges = None
+        return self
+
+    def _get_double_array(self):
+        # Built on the first lookup, so tries only exported to a pattern skip it
+        if self._base is not None:
+            return self._codes, self._base, self._check, self._state_keyword_id
+
+        self.compact()
+        num_nodes = len(self._parent)
+        char = self._char.tolist()
+        keyword_id = self._keyword_id.tolist()
+        edge_start = self._edge_start.tolist()
+        edge_nodes = self._edge_nodes.tolist()
+
+        # Frequent characters get small codes, which packs the double array tighter
+        char_freqs = {}
+        for c in char[1:]:
+            char_freqs[c] = char_freqs.get(c, 0) + 1
+        codes = {chr(c): i + 1 for i, c in enumerate(sorted(char_freqs, key=lambda c: -char_freqs[c]))}
+        node_code = [0] + [codes[chr(c)] for c in char[1:]]
+
+        base = [0] * num_nodes
+        check = [-1] * num_nodes
+        state_keyword_id = [-1] * num_nodes
+        check[0] = 0
+        state_keyword_id[0] = keyword_id[0]
+
+        node_state = [0] * num_nodes
+        next_free = 1
+        num_fails = 0
+        queue = [0]
+        for node in queue:
+            children = edge_nodes[edge_start[node]:edge_start[node + 1]]
+            if len(children) == 0:
+                continue
+
+            child_codes = [node_code[child] for child in children]
+            first_code = min(child_codes)
+            max_code = max(child_codes)
+
+            # Try each free slot for the smallest code. A slot that keeps
+            # failing as the first candidate is given up, so searches do not
+            # rescan the packed region behind it.
+            pos = _next_free_slot(check, next_free)
+            if pos != next_free:
+                next_free = pos
+                num_fails = 0
+
+            while True:
+                b = pos - first_code
+                if b >= 1:
+                    if b + max_code >= len(check):
+                        num_new = b + max_code + 1 - len(check)
+                        base += [0] * num_new
+                        check += [-1] * num_new
+                        state_keyword_id += [-1] * num_new
+                    if len(child_codes) == 1 or all(check[b + c] == -1 for c in child_codes):
+                        break
+                if pos == next_free:
+                    num_fails += 1
+                pos = _next_free_slot(check, pos + 1)
+
+            if num_fails > 16:
+                next_free += 1
+
+            state = node_state[node]
+            base[state] = b
+            for child, c in zip(children, child_codes):
+                check[b + c] = state
+                state_keyword_id[b + c] = keyword_id[child]
+                node_state[child] = b + c
+            queue += children
+
+        # Transitions from any state stay inside check, so lookups need no bounds test
+        num_pad = max(base) + len(codes) + 1 - len(check)
+        if num_pad > 0:
+            check += [-1] * num_pad
+            state_keyword_id += [-1] * num_pad
+
+        self._codes = codes
+        self._base = array('i', base)
+        self._check = array('i', check)
+        self._state_keyword_id = array('i', state_keyword_id)
+        return self._codes, self._base, self._check, self._state_keyword_id
+
+    def _children(self, node):
+        # (char, child) pairs sorted by char
+        self.compact()
+        return [(chr(self._char[child]), child)
+                for child in self._edge_nodes[self._edge_start[node]:self._edge_start[node + 1]]]
+
+    def _ordered_children(self, node):
+        # (char, child) pairs in the key order of the nested dicts the trie
+        # was built from: children by creation, with ('', -1) marking the
+        # end of a word where it was added
+        children = sorted(self._children(node), key=lambda t: t[1])
+
+        keyword_id = self._keyword_id[node]
+        if keyword_id >= 0:
+            num_nodes = self._keyword_num_nodes[keyword_id]
+            pos = sum(1 for _, child in children if child < num_nodes)
+            children.insert(pos, ('', -1))
+
+        return children
+
+    def get_keyword_id(self, word):
+        """Returns the id of word, or -1 if it was never added."""
+        if self._edges is not None:
+            node = 0
+            for char in word:
+                node = self._edges.get((node, char))
+                if node is None:
+                    return -1
+            return self._keyword_id[node]
+
+        codes, base, check, keyword_id = self._get_double_array()
+        state = 0
+        for char in word:
+            code = codes.get(char)
+            if code is None or check[base[state] + code] != state:
+                return -1
+            state = base[state] + code
+
+        return keyword_id[state]
+
+    def _word(self, node):
+        chars = []
+        while node > 0:
+            chars.append(chr(self._char[node]))
+            node = self._parent[node]
+        return ''.join(reversed(chars))
+
+    def keywords(self):
+        """Returns every word added to the trie, ordered by keyword id."""
+        return [self._word(node) for node in self._keyword_nodes]
+
+    def _dump_node(self, node):
+        res = {}
+        for char, child in self._ordered_children(node):
+            res[char] = self._dump_node(child) if child >= 0 else 1
+        return res
 
     def dump(self):
-        return self.data
+        """
+        Returns the trie as nested dicts, with '' marking the end of a word.
+        The dicts are built on every call, so callers should keep the result.
+        """
+        return self._dump_node(0)
+
+    @property
+    def data(self):
+        """Same as dump(): materialized on demand, on every access."""
+        return self.dump()
 
     @staticmethod
     def quote(char):
@@ -62,33 +308,95 @@ class Trie():
                 result = "(?:%s)?" % result
         return result
 
+    def _node_pattern(self, node):
+        # Same output as _pattern on the dumped node
+        children = self._children(node)
+        q = self._keyword_id[node] >= 0
+        if q and len(children) == 0:
+            return None
+
+        alt = []
+        cc = []
+        for char, child in children:
+            recurse = self._node_pattern(child)
+            if recurse is None:
+                cc.append(Trie.quote(char))
+            else:
+                alt.append(Trie.quote(char) + recurse)
+        cconly = not len(alt) > 0
+
+        if len(cc) > 0:
+            if len(cc) == 1:
+                alt.append(cc[0])
+            else:
+                alt.append('[' + ''.join(cc) + ']')
+
+        if len(alt) == 1:
+            result = alt[0]
+        else:
+            result = "(?:" + "|".join(alt) + ")"
+
+        if q:
+            if cconly:
+                result += "?"
+            else:
+                result = "(?:%s)?" % result
+        return result
+
 
     def get_matches(self, inp_text, start_idx=0):
 
         matches = []
-        curr_dict = self.data
+        if self._base is None:
+            self._get_double_array()
+        codes = self._codes
+        base = self._base
+        check = self._check
+        keyword_id = self._state_keyword_id
+
+        state = 0
         curr_idx = start_idx
-        cuml_word = ""
 
-        while curr_idx < len(inp_text) and curr_dict is not None:
-            curr_char = inp_text[curr_idx]
-            cuml_word += curr_char
+        text_len = len(inp_text)
 
-            if curr_char in curr_dict:
-                curr_dict = curr_dict[curr_char]
+        while curr_idx < text_len:
+            code = codes.get(inp_text[curr_idx])
+            if code is None:
+                break
 
-                if '' in curr_dict:
-                    matches.append(cuml_word)
-            else:
-                curr_dict = None
+            next_state = base[state] + code
+            if check[next_state] != state:
+                break
 
+            state = next_state
             curr_idx += 1
 
+            if keyword_id[state] >= 0:
+                matches.append(inp_text[start_idx:curr_idx])
+
         return matches
 
 
+    def _node_keywords(self, node, prefix):
+        # Same order as _keywords on the dumped node
+        res = []
+        stack = [(node, prefix)]
+        while stack:
+            node, prefix = stack.pop()
+            if node < 0:
+                res.append(prefix)
+                continue
+            for char, child in reversed(self._ordered_children(node)):
+                stack.append((child, prefix + char))
+
+        return res
+
     @staticmethod
     def _keywords(kw_trie, prefix=''):
+        # kw_trie is a Trie or a dict from dump()
+        if isinstance(kw_trie, Trie):
+            return kw_trie._node_keywords(0, prefix)
+
         if type(kw_trie) is not dict:
             return [prefix]
 
@@ -107,8 +415,38 @@ class Trie():
             return res
 
 
+    def _node_groups(self, require_root=True):
+        # Same order as get_groups on the dumped trie
+        kw_groups = []
+        stack = [(0, '')]
+
+        while stack:
+            node, prefix = stack.pop()
+            if node < 0:
+                kw_groups.append([prefix])
+                continue
+
+            children = self._ordered_children(node)
+            space_child = next((child for char, child in children if char == ' '), -1)
+
+            grouped_root = space_child >= 0 and (self._keyword_id[node] >= 0 or not require_root)
+            if grouped_root:
+                break_group = self._node_keywords(space_child, prefix + ' ')
+                break_group.append(prefix)
+                kw_groups.append(break_group)
+
+            for char, child in reversed(children):
+                if not grouped_root or (char != ' ' and char != ''):
+                    stack.append((child, prefix + char))
+
+        return kw_groups
+
     @staticmethod
     def get_groups(kwd_trie, require_root=True):
+        # kwd_trie is a Trie or a dict from dump()
+        if isinstance(kwd_trie, Trie):
+            return kwd_trie._node_groups(require_root)
+
         kw_groups = []
 
         def get_groups_helper(kwd_trie_loc, global_groups, prefix=''):
@@ -137,4 +475,4 @@ class Trie():
 
 
     def pattern(self):
-        return Trie._pattern(self.dump())
+        return self._node_pattern(0)
@@ -0,0 +1,133 @@
+"""
+Compares the keyword matcher engines on abstract-length texts.
+
+Usage (from keyword_assignment/):
+    python -m trie.benchmark
+    python -m trie.benchmark --keywords setup_data/golden_words.csv --abstracts abstracts.txt
+
+--keywords is a csv with a 'word' column (golden_words.csv); --abstracts is
+a text file with one abstract per line. Without them a synthetic vocabulary
+and synthetic abstracts of typical lengths (600 - 2500 characters) are used.
+"""
+import csv
+import time
+import random
+import argparse
+
+from .utils import construct_trie, construct_re, construct_matcher, get_matches, get_matches_overlap, match_corpus
+
+
+def read_keywords(keywords_file):
+    with open(keywords_file, newline='', encoding='utf-8') as f:
+        return [row['word'] for row in csv.DictReader(f) if row['word']]
+
+
+def make_synthetic_data(num_keywords, num_abstracts, seed=0):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(5000)]
+
+    keywords = set()
+    while len(keywords) < num_keywords:
+        keywords.add(' '.join(rng.choice(words) for _ in range(rng.randint(1, 3))))
+    keywords = list(keywords)
+
+    abstracts = []
+    for _ in range(num_abstracts):
+        target_len = rng.choice([600, 1200, 1800, 2500])
+        parts = []
+        length = 0
+        while length < target_len:
+            part = rng.choice(keywords) if rng.random() < 0.1 else rng.choice(words)
+            if rng.random() < 0.08:
+                part += rng.choice(['.', ',', ';'])
+            parts.append(part)
+            length += len(part) + 1
+        abstracts.append(' '.join(parts))
+
+    return keywords, abstracts
+
+
+def check_incremental_adds():
+    """
+    Checks that lookups see words added after the trie was compacted and
+    searched, including words whose nodes already exist (prefixes of
+    added words), like the dict-based trie did.
+    """
+    kw_trie = construct_trie(['abc'])
+    assert kw_trie.get_matches('abc') == ['abc']
+
+    kw_trie.add('ab')
+    assert kw_trie.get_matches('abc') == ['ab', 'abc']
+    assert kw_trie.get_keyword_id('ab') == 1
+
+    kw_trie.add('abcd')
+    kw_trie.compact()
+    assert kw_trie.get_matches('abcd') == ['ab', 'abc', 'abcd']
+    assert kw_trie.keywords() == ['abc', 'ab', 'abcd']
+
+
+def time_call(func, texts):
+    start = time.perf_counter()
+    results = [func(text) for text in texts]
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark keyword matcher engines")
+    parser.add_argument('--keywords', default=None, help="csv with a 'word' column")
+    parser.add_argument('--abstracts', default=None, help="text file, one abstract per line")
+    parser.add_argument('--num-keywords', type=int, default=30000)
+    parser.add_argument('--num-abstracts', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4, help="processes for the match_corpus timing")
+    args = parser.parse_args()
+
+    check_incremental_adds()
+
+    keywords, abstracts = make_synthetic_data(args.num_keywords, args.num_abstracts)
+    if args.keywords is not None:
+        keywords = read_keywords(args.keywords)
+    if args.abstracts is not None:
+        with open(args.abstracts, encoding='utf-8') as f:
+            abstracts = [line.strip() for line in f if line.strip()][:args.num_abstracts]
+
+    avg_len = sum(len(text) for text in abstracts) / len(abstracts)
+    print("Keywords: " + str(len(keywords)) + ", abstracts: " + str(len(abstracts))
+          + ", average abstract length: " + str(round(avg_len)) + " chars")
+
+    start = time.perf_counter()
+    kw_trie = construct_trie(keywords)
+    trie_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    keywords_re = construct_re(kw_trie)
+    re_build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    automaton = construct_matcher(kw_trie, 'aho-corasick')
+    ac_build_time = time.perf_counter() - start
+
+    print("Build: trie %.3fs, regex %.3fs, aho-corasick %.3fs" % (trie_time, re_build_time, ac_build_time))
+
+    re_time, re_res = time_call(lambda text: get_matches(text, keywords_re, True), abstracts)
+    ac_time, ac_res = time_call(lambda text: get_matches(text, automaton, True), abstracts)
+    overlap_time, _ = time_call(lambda text: get_matches_overlap(text, kw_trie, True), abstracts)
+    ac_overlap_time, _ = time_call(lambda text: automaton.get_matches(text, True, overlapping=True), abstracts)
+
+    num_same = sum(1 for a, b in zip(re_res, ac_res) if a == b)
+
+    print("Non-overlapping matches with counts:")
+    print("    regex:        %.2f ms / abstract" % (1000 * re_time / len(abstracts)))
+    print("    aho-corasick: %.2f ms / abstract (same result for %d / %d abstracts)"
+          % (1000 * ac_time / len(abstracts), num_same, len(abstracts)))
+    print("Overlapping matches with counts:")
+    print("    get_matches_overlap: %.2f ms / abstract" % (1000 * overlap_time / len(abstracts)))
+    print("    aho-corasick:        %.2f ms / abstract" % (1000 * ac_overlap_time / len(abstracts)))
+
+    automaton.set_keyword_ids(lambda keyword: automaton.keyword_to_idx[keyword])
+    for workers in sorted({1, args.workers}):
+        start = time.perf_counter()
+        for _ in match_corpus(abstracts, automaton, len(automaton), 100, workers):
+            pass
+        corpus_time = time.perf_counter() - start
+        print("match_corpus, %d worker(s): %.2f ms / abstract" % (workers, 1000 * corpus_time / len(abstracts)))
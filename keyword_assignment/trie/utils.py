@@ -1,5 +1,12 @@
 from .Trie import Trie
+from .AhoCorasick import AhoCorasick
 import re
+import pickle
+import numpy as np
+import scipy.sparse as sp
+from itertools import islice
+from collections import deque
+from multiprocessing import Pool
 
 
 # Trie regexp for efficient unioning
@@ -12,7 +19,7 @@ def construct_trie(keywords):
         else:
             trie.add(keyword)
 
-    return trie
+    return trie.compact()
 
 
 def construct_re(trie, include_space=False):
@@ -25,7 +32,70 @@ def construct_re(trie, include_space=False):
 
 
 
+def construct_matcher(trie, engine='regex'):
+    """
+    Builds the keyword matcher passed to get_matches.
+
+    engine is 'regex' (one compiled regex, see construct_re) or
+    'aho-corasick' (an AhoCorasick automaton with the same matches).
+    """
+    if engine == 'regex':
+        return construct_re(trie)
+    elif engine == 'aho-corasick':
+        return AhoCorasick.from_trie(trie)
+
+    raise ValueError("Unknown matcher engine: " + str(engine))
+
+
+# 2: Aho-Corasick keywords are NFC normalized
+matcher_format_version = 2
+matcher_file_magic = b'KWMATCHER\n'
+
+
+def save_matcher(matcher, out_file):
+    """
+    Saves a matcher from construct_matcher (including any keyword ids) so
+    other processes can load it with load_matcher instead of rebuilding the
+    trie and pattern.
+
+    The file starts with a magic string and a pickled header holding the
+    format version and engine, followed by the pickled matcher.
+    """
+    engine = 'aho-corasick' if isinstance(matcher, AhoCorasick) else 'regex'
+    header = {'version': matcher_format_version, 'engine': engine}
+
+    with open(out_file, 'wb') as f:
+        f.write(matcher_file_magic)
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(matcher, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_matcher(matcher_file):
+    """
+    Returns: (matcher, engine) saved by save_matcher. Raises ValueError if
+    the file is not a matcher file of the current format version.
+
+    An Aho-Corasick matcher loads directly from its tables. A regex
+    matcher is recompiled by the re module on load, which takes about as
+    long as construct_re, so only Aho-Corasick files load fast.
+    """
+    with open(matcher_file, 'rb') as f:
+        if f.read(len(matcher_file_magic)) != matcher_file_magic:
+            raise ValueError(matcher_file + " is not a keyword matcher file")
+
+        header = pickle.load(f)
+        if header['version'] != matcher_format_version:
+            raise ValueError("Keyword matcher file " + matcher_file + " has format version "
+                             + str(header['version']) + ", expected " + str(matcher_format_version))
+
+        return pickle.load(f), header['engine']
+
+
 def get_matches(inp_text, keywords_re, include_counts=False):
+    # keywords_re is a compiled regex from construct_re or an AhoCorasick
+    if isinstance(keywords_re, AhoCorasick):
+        return keywords_re.get_matches(inp_text, include_counts)
+
     keyword_matches = re.finditer(keywords_re, inp_text)
     keyword_matches = map(lambda s : s.group().lower(), keyword_matches)
 
@@ -44,6 +114,114 @@ def get_matches(inp_text, keywords_re, include_counts=False):
     return list(keyword_matches)
 
 
+def get_match_ids(inp_text, keywords_re, get_id=None, overlapping=False):
+    """
+    Finds keyword matches as keyword ids instead of strings.
+
+    Arguments:
+    - keywords_re: AhoCorasick with keyword ids set (see
+      AhoCorasick.set_keyword_ids), or a compiled regex from construct_re
+    - get_id: function mapping a lowercased keyword to its id or None,
+      only used (and required) for a regex matcher
+    - overlapping: also count keywords overlapping another match
+      (Aho-Corasick only)
+
+    Returns: list of (keyword_id, count) sorted by count, most frequent
+    first. Keywords without an id are left out.
+    """
+    if isinstance(keywords_re, AhoCorasick):
+        id_counts = keywords_re.count_ids(inp_text, overlapping)
+    else:
+        if overlapping:
+            raise ValueError("Overlapping matches need an Aho-Corasick matcher")
+
+        id_counts = {}
+        for keyword, count in get_matches(inp_text, keywords_re, True):
+            keyword_id = get_id(keyword)
+            if keyword_id is not None:
+                id_counts[keyword_id] = id_counts.get(keyword_id, 0) + count
+
+    return sorted(id_counts.items(), key=lambda t: t[1], reverse=True)
+
+
+def match_texts(texts, keywords_re, num_keywords, get_id=None):
+    """
+    Matches a list of texts into one sparse match-count matrix.
+
+    Arguments:
+    - texts: list of texts
+    - keywords_re, get_id: as for get_match_ids
+    - num_keywords: size of the keyword id space
+
+    Returns: scipy csr_matrix of shape (len(texts), num_keywords) whose row i
+    holds the match count of every keyword id found in texts[i]. Entries of
+    a row are ordered like get_match_ids (most frequent first), so the rows
+    can go straight to keyword_scoring.score_block.
+    """
+    indptr = np.zeros(len(texts) + 1, dtype=np.int64)
+    indices = []
+    counts = []
+
+    for i, text in enumerate(texts):
+        for keyword_id, count in get_match_ids(text, keywords_re, get_id):
+            indices.append(keyword_id)
+            counts.append(count)
+        indptr[i + 1] = len(indices)
+
+    return sp.csr_matrix((np.array(counts, dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+                         shape=(len(texts), num_keywords))
+
+
+# Matcher of a match_corpus worker process, set by _init_corpus_worker
+_corpus_matcher = None
+_corpus_get_id = None
+
+
+def _init_corpus_worker(keywords_re, get_id):
+    global _corpus_matcher, _corpus_get_id
+    _corpus_matcher = keywords_re
+    _corpus_get_id = get_id
+
+
+def _match_corpus_chunk(texts, num_keywords):
+    return match_texts(texts, _corpus_matcher, num_keywords, _corpus_get_id)
+
+
+def match_corpus(texts, keywords_re, num_keywords, chunk_size=1000, workers=1, get_id=None):
+    """
+    Lazily matches a stream of texts, chunk_size texts at a time.
+
+    Arguments:
+    - texts: any iterable of texts; it is read one chunk at a time, so it
+      can be a generator over a whole corpus
+    - keywords_re, num_keywords, get_id: as for match_texts; with
+      workers > 1 they are pickled once to each worker, so get_id must be a
+      module-level function (or None)
+    - chunk_size: number of texts per yielded matrix
+    - workers: number of processes matching chunks in parallel
+
+    Yields: one csr_matrix from match_texts per chunk, in input order. At
+    most 2 * workers chunks are in flight at a time.
+    """
+    text_iter = iter(texts)
+    chunks = iter(lambda: list(islice(text_iter, chunk_size)), [])
+
+    if workers <= 1:
+        for chunk in chunks:
+            yield match_texts(chunk, keywords_re, num_keywords, get_id)
+        return
+
+    with Pool(workers, initializer=_init_corpus_worker, initargs=(keywords_re, get_id)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_match_corpus_chunk, (chunk, num_keywords)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+
 def get_matches_overlap(inp_text, trie, include_counts=False):
     word_start_re = re.compile(r"\b(\w)")
 
@@ -1,8 +1,10 @@
 import re
 import string
 import pickle
-from random import randrange
+import heapq
 import unicodedata
+import numpy as np
+import scipy.sparse as sp
 
 
 # https://stackoverflow.com/questions/43593428/splitting-a-sentence-by-ending-characters/43596240
@@ -44,46 +46,291 @@ def concat_paper_info(paper_title, paper_abstract):
     return paper_title + '. ' + paper_abstract
 
 
+def stream_papers(db, batch_size=1000, start_after_id=None, shard=None):
+    """
+    Lazily yields papers with an abstract, in increasing id order
+
+    Arguments:
+    - db: mysql connection
+    - batch_size: number of rows fetched per round trip
+    - start_after_id: if given, only papers with id > start_after_id are
+      yielded (used to resume an interrupted run)
+    - shard: optional (shard_idx, num_shards) to only yield papers with
+      id % num_shards == shard_idx
+
+    Returns: generator of (id, title, abstract) tuples.
+
+    Rows are read one batch at a time by seeking on the primary key
+    (WHERE id > last_id ORDER BY id LIMIT batch_size), so at most one batch
+    is held in memory. Unlike an unbuffered cursor this leaves the
+    connection free between batches, so callers can keep inserting and
+    committing on the same connection while they iterate.
+    """
+    select_sql = """
+        SELECT id, title, abstract
+        FROM Publication
+        WHERE abstract IS NOT NULL
+        AND id > %s
+    """
+    shard_params = []
+    if shard is not None:
+        select_sql += " AND MOD(id, %s) = %s"
+        shard_params = [shard[1], shard[0]]
+
+    select_sql += " ORDER BY id LIMIT %s"
+
+    last_id = start_after_id if start_after_id is not None else -1
+    cur = db.cursor()
+    try:
+        while True:
+            cur.execute(select_sql, [last_id] + shard_params + [batch_size])
+            batch = cur.fetchall()
+
+            for paper in batch:
+                yield paper
+
+            if len(batch) < batch_size:
+                break
+            last_id = batch[-1][0]
+    finally:
+        cur.close()
+
+
+def fetch_columns(cur, select_sql, dtypes, params=None, fetch_size=100000):
+    """
+    Runs a query and returns its result column by column
+
+    Arguments:
+    - cur: mysql cursor
+    - select_sql, params: query and its parameters
+    - dtypes: one numpy dtype per selected column
+    - fetch_size: number of rows converted at a time
+
+    Returns: list with one numpy array per column.
+    """
+    # Leaves out params when there are none, as sqlite3 cursors require
+    if params is None:
+        cur.execute(select_sql)
+    else:
+        cur.execute(select_sql, params)
 
-# Quickselect algorithm from
-# https://pythonandr.com/2016/07/18/randomized-selection-algorithm-quickselect-python-code/
-def partition(x, key, pivot_index = 0):
-    i = 0
-    if pivot_index != 0:
-        x[0], x[pivot_index] = x[pivot_index], x[0]
-
-    for j in range(len(x)-1):
-        if key(x[j+1]) < key(x[0]):
-            x[j+1],x[i+1] = x[i+1],x[j+1]
-            i += 1
+    col_chunks = [[] for _ in dtypes]
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if len(rows) == 0:
+            break
 
-    x[0],x[i] = x[i],x[0]
-    return x,i
+        for i, col in enumerate(zip(*rows)):
+            col_chunks[i].append(np.array(col, dtype=dtypes[i]))
 
+    return [np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=dtype)
+            for chunks, dtype in zip(col_chunks, dtypes)]
 
-def RSelect(x, k, key=lambda t: t):
-    if len(x) == 1:
-        return x[0]
-    else:
-        xpart = partition(x, key, randrange(len(x)))
-        x = xpart[0] # partitioned array
-        j = xpart[1] # pivot index
-        if j == k:
-            return x[j]
-        elif j > k:
-            return RSelect(x[:j], k, key)
-        else:
-            k = k - j - 1
-            return RSelect(x[(j+1):], k, key)
 
+def get_chunks(iterable, chunk_size):
+    """
+    Groups the items of an iterable into lists of at most chunk_size items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
 
-def get_top_k(data, k, key=lambda t: t):
-    thresh_elem_idx = len(data) - k
-    thresh_elem = RSelect(data, thresh_elem_idx, key)
+    if len(chunk) > 0:
+        yield chunk
 
-    return sorted(filter(lambda t: key(t) >= key(thresh_elem), data), key=key, reverse=True)
 
 
+def get_top_k(data, k, key=lambda t: t):
+    """
+    Returns the k items of data with the largest key, largest first.
+
+    Items with equal keys keep their order in data, so exactly
+    min(k, len(data)) items are returned and the result is deterministic.
+    """
+    if k <= 0:
+        return []
+
+    return heapq.nlargest(k, data, key=key)
+
+
+def get_top_k_indices(scores, k):
+    """
+    Array version of get_top_k.
+
+    Arguments:
+    - scores: 1-D numpy array
+    - k: number of indices to return
+
+    Returns: int64 array with the indices of the min(k, len(scores)) largest
+    scores, largest first; equal scores are ordered by index.
+    """
+    scores = np.asarray(scores)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if k < len(scores):
+        # argpartition picks an arbitrary subset of the scores tied with the
+        # k-th largest, so keep all larger scores and the earliest ties
+        thresh = np.partition(scores, len(scores) - k)[len(scores) - k]
+        is_tie = scores == thresh
+        num_ties = k - np.count_nonzero(scores > thresh)
+        candidates = np.flatnonzero((scores > thresh) | (is_tie & (np.cumsum(is_tie) <= num_ties)))
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.argsort(-scores[candidates], kind='stable')
+    return candidates[order].astype(np.int64)
+
+
+def get_top_k_rows(scores, k):
+    """
+    Batched get_top_k_indices: the top k entries of every row of a score matrix.
+
+    Arguments:
+    - scores: dense (num_rows, num_cols) numpy array, or scipy csr_matrix
+      whose stored entries are the candidates of each row
+    - k: number of entries per row, an int or an array with one k per row
+
+    Returns:
+    - for a dense array: (num_rows, min(k, num_cols)) int64 array of column
+      indices, largest score first (k must be an int)
+    - for a csr_matrix: csr_matrix with the same shape holding only the top
+      min(k, row length) entries of each row, largest first
+
+    Equal scores are ordered by column index (dense) or by position in the
+    row (csr), as in get_top_k.
+    """
+    if sp.issparse(scores):
+        scores = scores.tocsr()
+        row_lens = np.diff(scores.indptr)
+        rows = np.repeat(np.arange(scores.shape[0]), row_lens)
+        positions = np.arange(len(scores.data))
+
+        # Sort each row by score, largest first, keeping row order for ties
+        order = np.lexsort((positions, -scores.data, rows))
+        ranks = positions - scores.indptr[rows]
+        keep = order[ranks < np.broadcast_to(k, scores.shape[:1])[rows]]
+
+        top_lens = np.bincount(rows[keep], minlength=scores.shape[0])
+        indptr = np.zeros(scores.shape[0] + 1, dtype=np.int64)
+        np.cumsum(top_lens, out=indptr[1:])
+
+        return sp.csr_matrix((scores.data[keep], scores.indices[keep], indptr), shape=scores.shape)
+
+    scores = np.asarray(scores)
+    num_rows, num_cols = scores.shape
+    k = min(k, num_cols)
+    if k <= 0:
+        return np.zeros((num_rows, 0), dtype=np.int64)
+
+    if k < num_cols:
+        # Same tie handling as get_top_k_indices, row by row
+        thresh = np.partition(scores, num_cols - k, axis=1)[:, num_cols - k][:, None]
+        is_tie = scores == thresh
+        num_ties = k - np.count_nonzero(scores > thresh, axis=1)[:, None]
+        selected = (scores > thresh) | (is_tie & (np.cumsum(is_tie, axis=1) <= num_ties))
+        candidates = np.nonzero(selected)[1].reshape(num_rows, k)
+    else:
+        candidates = np.tile(np.arange(num_cols), (num_rows, 1))
+
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1).astype(np.int64)
+
+
+class BulkInserter():
+    """
+    Buffers rows for one table and writes them in batches with executemany
+    (which mysql.connector sends as a single multi-row INSERT).
+
+    Arguments:
+    - db: mysql connection; the inserter uses its own cursor on it
+    - table_name: table to insert into
+    - columns: list of column names, in the order rows are given
+    - batch_size: number of buffered rows that triggers a write
+    - commit_size: minimum number of written rows between commits
+
+    Rows are only committed from commit_if_due() and close(), so callers can
+    call commit_if_due() at a unit-of-work boundary (e.g. after each paper)
+    and never commit half of a unit.
+
+    If a write or commit fails, the transaction is rolled back and every row
+    since the last commit is dropped before the error is raised, so the
+    caller knows exactly which units were lost and later writes start clean.
+    """
+
+    def __init__(self, db, table_name, columns, batch_size=1000, commit_size=10000):
+        self.db = db
+        self.cur = db.cursor()
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+
+        self.insert_sql = "INSERT INTO " + table_name + " (" + ", ".join(columns) + ") VALUES " \
+            + gen_sql_in_tup(len(columns))
+
+        self.rows = []
+        self.num_uncommitted = 0
+        self.num_written = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+
+        try:
+            self.cur.executemany(self.insert_sql, self.rows)
+        except Exception:
+            self.rollback()
+            raise
+
+        self.num_uncommitted += len(self.rows)
+        self.num_written += len(self.rows)
+        self.rows = []
+
+    def commit(self):
+        self.flush()
+        try:
+            self.db.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+        self.num_uncommitted = 0
+
+    def commit_if_due(self):
+        """
+        Returns: True if the rows were committed.
+        """
+        if self.num_uncommitted + len(self.rows) >= self.commit_size:
+            self.commit()
+            return True
+        return False
+
+    def rollback(self):
+        """
+        Drops every row written or buffered since the last commit.
+        """
+        self.num_written -= self.num_uncommitted
+        self.rows = []
+        self.num_uncommitted = 0
+        self.db.rollback()
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.cur.close()
 
 
 def standardize_non_ascii(s):
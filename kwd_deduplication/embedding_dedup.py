@@ -1,31 +1,68 @@
+"""
+Removes near-duplicate keywords using Sentence-BERT embeddings.
+
+Importing this module is cheap: the model is only loaded (once per process)
+when a keyword is not in the embedding cache. Long-running services can
+call warm_up() at startup so the first request does not pay for loading.
+"""
+import os
+import sys
+import threading
 import numpy as np
 import numpy.linalg as la
 
-from sklearn.cluster import DBSCAN
-from sentence_transformers import SentenceTransformer
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../keyword_assignment'))
+from keyword_graph import get_dedup_labels_from_embs
+from embedding_cache import EmbeddingCache, CachedEncoder
 
 def normalize_embs(emb_arr):
     emb_norms = la.norm(emb_arr, axis=1)
     return emb_arr / emb_norms[:,None]
 
 
-model = SentenceTransformer('bert-base-nli-mean-tokens')
+model_name = 'bert-base-nli-mean-tokens'
 
+_model = None
+_encoder = None
+_init_lock = threading.Lock()
 
-def remove_duplicates(keywords):
 
-    keyword_embs = model.encode(keywords)
-    keyword_embs = np.array(keyword_embs)
-    keyword_embs = normalize_embs(keyword_embs)
+def get_model():
+    """
+    Returns the process-wide SentenceTransformer, loading it on first use.
+    """
+    global _model
+    if _model is None:
+        with _init_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(model_name)
+
+    return _model
+
 
-    db = DBSCAN(eps=0.47815, min_samples=2).fit(keyword_embs)
+def get_encoder():
+    """
+    Returns the process-wide cached encoder. Recurring keywords are served
+    from the cache instead of the model.
+    """
+    global _encoder
+    if _encoder is None:
+        with _init_lock:
+            if _encoder is None:
+                _encoder = CachedEncoder(EmbeddingCache(model_name=model_name), get_model)
 
+    return _encoder
 
-    # Contains group index for each keyword
-    # See sklearn documentation of DBSCAN for more info
-    labels = db.labels_
 
+def warm_up():
+    """
+    Loads the model and runs one encode so later calls start fast.
+    """
+    get_model().encode(['warm up'])
 
+
+def get_unique_keywords(keywords, labels):
     # Removing duplicates based on keyword groupings
     picked_groups = set()
     unique_keywords = []
@@ -43,5 +80,43 @@ def remove_duplicates(keywords):
     return unique_keywords
 
 
-test_keywords = ['algorithm', 'algorithms', 'machines']
-print(remove_duplicates(test_keywords))
+def remove_duplicates(keywords):
+
+    keyword_embs = get_encoder().encode(keywords)
+    keyword_embs = np.array(keyword_embs)
+    keyword_embs = normalize_embs(keyword_embs)
+
+    # Contains group index for each keyword, same as the labels of
+    # DBSCAN(eps=0.47815, min_samples=2); see keyword_graph.py
+    labels = get_dedup_labels_from_embs(keyword_embs)
+
+    return get_unique_keywords(keywords, labels)
+
+
+def remove_duplicates_many(keyword_lists):
+    """
+    Same as [remove_duplicates(keywords) for keywords in keyword_lists], but
+    all keywords are encoded in a single call.
+    """
+    all_keywords = [keyword for keywords in keyword_lists for keyword in keywords]
+    if len(all_keywords) == 0:
+        return [[] for keywords in keyword_lists]
+
+    all_embs = normalize_embs(np.array(get_encoder().encode(all_keywords)))
+
+    res = []
+    start = 0
+    for keywords in keyword_lists:
+        keyword_embs = all_embs[start:start + len(keywords)]
+        start += len(keywords)
+
+        labels = get_dedup_labels_from_embs(keyword_embs)
+        res.append(get_unique_keywords(keywords, labels))
+
+    return res
+
+
+if __name__ == '__main__':
+    test_keywords = ['algorithm', 'algorithms', 'machines']
+    print(remove_duplicates(test_keywords))
+    print(remove_duplicates_many([test_keywords, ['data mining', 'data-mining'], []]))